@@ -7,6 +7,8 @@ Restrictions:
         * Dataset: class-balanced sharp, 24 hr observation
         * Model: 3D CNN
 """
+import copy
+
 from arnet.utils import CfgNode as CN
 
 cfg = CN()
@@ -16,6 +18,10 @@ cfg.DATA.DATABASE = '/home/zeyusun/work/flare-prediction-smarp/datasets/M_Q_24hr
 cfg.DATA.DATASET = 'sharp'
 cfg.DATA.AUXDATA = '/home/zeyusun/work/flare-prediction-smarp/datasets/sharp2smarp.npy'
 cfg.DATA.BALANCED = True
+# Label a master table (preprocess.py --master) at load time, e.g., 'M_QS'
+# and 24 (hours). None: DATABASE is already labeled.
+cfg.DATA.CRITERION = None
+cfg.DATA.HORIZON = None
 cfg.DATA.SEED = None
 cfg.DATA.VAL_SPLIT = 0
 cfg.DATA.TEST_SPLIT = 0
@@ -31,12 +37,35 @@ cfg.DATA.WIDTH = 128
 # Dataloader config
 cfg.DATA.BATCH_SIZE = 64
 cfg.DATA.NUM_WORKERS = 8
+cfg.DATA.PREFETCH_FACTOR = 2 # batches loaded in advance by each worker
+cfg.DATA.PERSISTENT_WORKERS = False
+# Group batches by magnetogram size instead of resizing. Spatial transforms
+# are skipped; use with LEARNER.MODEL.ADAPTIVE_POOL.
+cfg.DATA.BUCKETING = False
+cfg.DATA.BUCKET_GRANULARITY = 8 # pixels
+# Parameter-only features: load all sequences into one tensor, no workers
+cfg.DATA.IN_MEMORY = True
 cfg.DATA.TRANSFORMS = [
-    'Resize', # 'CenterCropPad'
+    'Resize', # 'CenterCropPad', 'FrameResize'
     #'ValueTransform',
     'Standardize',
     #'Reverse',
 ]
+# FrameResize: per-frame 2D interpolation (no temporal resampling)
+cfg.DATA.RESIZE_MODE = 'area' # 'area', 'bilinear', 'bicubic', 'nearest'
+cfg.DATA.RESIZE_ANTIALIAS = False # bilinear/bicubic only, torch>=1.11
+# Cache transformed videos (float16) on local disk. Empty string disables.
+# Entries are keyed by the transform config, see transforms.get_transform_hash
+cfg.DATA.CACHE_DIR = ''
+# Stream training samples from tar shards (run_arnet.py --modes write_shards).
+# Empty string reads samples by random access.
+cfg.DATA.SHARD_DIR = ''
+cfg.DATA.SHARD_SIZE = 1000 # samples per shard
+cfg.DATA.SHUFFLE_BUFFER = 1000 # samples
+# Train temporal heads on frozen per-frame embeddings (run_arnet.py --modes embed)
+# of the backbone in EMBEDDING_CHECKPOINT. Empty string disables.
+cfg.DATA.EMBEDDING_DIR = ''
+cfg.DATA.EMBEDDING_CHECKPOINT = ''
 cfg.DATA.SHRINKAGE = 'log'
 cfg.DATA.THRESH = 150
 cfg.DATA.IMAGE_MEAN = 0
@@ -47,18 +76,50 @@ cfg.LEARNER.CLASS_WEIGHT = [1, 1] # list or 'balanced', default=None
 cfg.LEARNER.LEARNING_RATE = 1e-4 # Don't change it here!
 cfg.LEARNER.CHECKPOINT = "" # path to checkpoint file to read from
 cfg.LEARNER.PATIENCE = 8
+cfg.LEARNER.METRIC_INTERVAL = 5.0 # seconds between MLflow metric flushes. 0: synchronous
 ### For visualization
 cfg.LEARNER.VIS = CN()
 cfg.LEARNER.VIS.GRADCAM_LAYERS = ['convs.conv5']
 cfg.LEARNER.VIS.ACTIVATIONS = ['convs.conv1', 'convs.conv2']
 cfg.LEARNER.VIS.HISTOGRAM = ['convs.conv3', 'linears.linear1']
+# Evaluation figures are rendered in background processes
+cfg.LEARNER.VIS.RENDER_WORKERS = 1 # 0: render synchronously
+cfg.LEARNER.VIS.FIGURE_EVERY_N_EPOCHS = 1 # 0: never during validation
+cfg.LEARNER.VIS.FIGURE_BEST_ONLY = False # only when validation0/tss improves
+# Training step diagnostics, every N steps (epochs for META). 0: never.
+# A non-empty PROFILE ('off', 'light', 'full') overrides the intervals, see
+# learner.VIS_PROFILES. Use 'off' for production training.
+cfg.LEARNER.VIS.PROFILE = ''
+cfg.LEARNER.VIS.HISTOGRAM_EVERY_N_STEPS = 1
+cfg.LEARNER.VIS.META_EVERY_N_EPOCHS = 1 # first batch of the epoch
+cfg.LEARNER.VIS.ACTIVATIONS_EVERY_N_STEPS = 0
+cfg.LEARNER.VIS.VIDEO_EVERY_N_STEPS = 0
+cfg.LEARNER.VIS.NAN_CHECK_EVERY_N_STEPS = 1 # synchronizes with the GPU
+# Training step time breakdown (data wait, transfer, compute, logging)
+cfg.LEARNER.THROUGHPUT = CN()
+cfg.LEARNER.THROUGHPUT.ENABLED = False
+cfg.LEARNER.THROUGHPUT.WINDOW = 100 # steps of rolling statistics
+cfg.LEARNER.THROUGHPUT.LOG_EVERY_N_STEPS = 50
+cfg.LEARNER.THROUGHPUT.INPUT_BOUND_RATIO = 0.3 # warn above this fraction of data wait
+cfg.LEARNER.THROUGHPUT.SYNC_CUDA = False # accurate device time per phase, slower
 ### For model
 cfg.LEARNER.MODEL = CN()
 cfg.LEARNER.MODEL.NAME = 'SimpleC3D'
 cfg.LEARNER.MODEL.SETTINGS = 'c3d'
+cfg.LEARNER.MODEL.ADAPTIVE_POOL = False # accept variable input H, W
+cfg.LEARNER.MODEL.INPUT_SIZE = 0 # MLP/SimpleLSTM. 0: len(DATA.FEATURES)
+# Train replicas of MODEL with different seeds in one run (models.ModelEnsemble).
+# Replica metrics and checkpoints are logged to child MLflow runs.
+cfg.LEARNER.ENSEMBLE = CN()
+cfg.LEARNER.ENSEMBLE.SIZE = 1 # > 1 enables the ensemble
+cfg.LEARNER.ENSEMBLE.SEEDS = [] # initialization seeds. Default: DATA.SEED + range(SIZE)
+cfg.LEARNER.ENSEMBLE.VECTORIZE = True # torch.func.vmap over replicas, if supported
 
 cfg.TRAINER = CN()
 cfg.TRAINER.strategy = None #"ddp" #None
+cfg.TRAINER.accelerator = None # 'cpu' for DDP over gloo on multi-core hosts
+cfg.TRAINER.num_processes = 1 # DDP processes with accelerator 'cpu'
+cfg.TRAINER.replace_sampler_ddp = False # the datamodule distributes its batch samplers
 cfg.TRAINER.gpus = 1 #2 #AssertionError: Invalid type <class 'NoneType'> for key gpus; valid types = {<class 'float'>,
 # If gpus = 2, can't debug inside training_step, where it shows two outputs and gives a warning: WARNING: your terminal doesn't support cursor position requests (CPR).
 cfg.TRAINER.fast_dev_run = False
@@ -79,3 +140,23 @@ cfg.TRAINER.profiler = None
 
 cfg.MISC = CN()
 cfg.MISC.OUTPUT_DIR = "outputs"
+
+
+def get_cfg_defaults():
+    """A copy of the default config."""
+    return cfg.clone()
+
+
+def add_missing_defaults(node, defaults=cfg):
+    """Add the keys of `defaults` that `node` lacks, in place, e.g., to the
+    config of a checkpoint saved before the keys were introduced.
+
+    Returns:
+        node
+    """
+    for k, v in defaults.items():
+        if k not in node:
+            dict.__setitem__(node, k, copy.deepcopy(v))
+        elif isinstance(v, CN) and isinstance(node[k], CN):
+            add_missing_defaults(node[k], v)
+    return node
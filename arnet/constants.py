@@ -1,28 +1,83 @@
 import os
 import json
+from glob import glob
 from functools import lru_cache
-import numpy as np
-import pandas as pd
 
 
 FEATURES = ['AREA', 'USFLUXL', 'MEANGBL', 'R_VALUE', 'FLARE_INDEX']
 #TODO: constants calculated on training set
 # relative address: code may be run from other directory, e.g., notebooks/
 # absolute address: different machine
-# Should use a env variable
-PROCESSED_DATA_DIR = '/home/zeyusun/work/flare-prediction-smarp/datasets/M_Q_24hr/'
+PROCESSED_DATA_DIR = os.environ.get('ARNET_PROCESSED_DATA_DIR',
+                                    '/home/zeyusun/work/flare-prediction-smarp/datasets/M_Q_24hr/')
+# Constants are computed once from the csv files and cached here
+CONSTANTS_FILE = 'constants.json'
 
-@lru_cache(8)
-def get_constants():
+
+def compute_constants(data_dir=PROCESSED_DATA_DIR):
+    import pandas as pd
+    from arnet.fusion import load_feature_files
     CONSTANTS = {}
     for dataset in ['sharp', 'smarp']:
-        filepath = os.path.join(PROCESSED_DATA_DIR, f'{dataset}.csv')
+        filepath = os.path.join(data_dir, f'{dataset}.csv')
         df = pd.read_csv(filepath)
+        # Also columns of feature files, e.g., arnet.sequence_features
+        columns = df.columns
+        df = load_feature_files(data_dir, dataset, df)
+        features = FEATURES + [c for c in df.columns if c not in columns]
+
+        CONSTANTS[dataset.upper() + '_MEAN'] = df[features].mean().to_dict()
+        CONSTANTS[dataset.upper() + '_STD'] = df[features].std().to_dict()
+    return CONSTANTS
+
+
+@lru_cache(8)
+def get_constants(data_dir=PROCESSED_DATA_DIR):
+    """Mean and std of the features, read from the cache file if it is newer
+    than the csv files (datasets and feature files).
+    """
+    data_dir = data_dir or PROCESSED_DATA_DIR
+    cache_path = os.path.join(data_dir, CONSTANTS_FILE)
+    mtime = max(os.path.getmtime(f) for f in glob(os.path.join(data_dir, '*.csv')))
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= mtime:
+        with open(cache_path) as f:
+            return json.load(f)
 
-        CONSTANTS[dataset.upper() + '_MEAN'] = df[FEATURES].mean().to_dict()
-        CONSTANTS[dataset.upper() + '_STD'] = df[FEATURES].std().to_dict()
+    CONSTANTS = compute_constants(data_dir)
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump(CONSTANTS, f, indent=2)
+    except OSError:
+        pass # read-only data directory
     return CONSTANTS
-CONSTANTS = get_constants()
-#print(json.dumps(CONSTANTS, indent=2))
+
+
+def get_feature_stats(dataset, features, data_dir=None):
+    """Mean and std lists of `features`, in that order, of 'SHARP' or 'SMARP'
+    samples in `data_dir` (default: ARNET_PROCESSED_DATA_DIR).
+
+    Training should pass cfg.DATA.DATABASE, the database whose samples, and
+    thus feature files, are loaded.
+    """
+    data_dir = data_dir or PROCESSED_DATA_DIR
+    CONSTANTS = get_constants(data_dir)
+    missing = [k for k in features if k not in CONSTANTS[dataset + '_MEAN']]
+    if missing:
+        from arnet.fusion import FEATURE_MODULES
+        files = ', '.join(
+            f"{os.path.join(data_dir, m.FEATURE_FILE.format(dataset=dataset.lower()))} "
+            f"(python -m {m.__name__} {data_dir})" for m in FEATURE_MODULES)
+        raise KeyError(f'No {dataset} statistics of {missing} in {data_dir}. Features other than '
+                       f'{FEATURES} are read from the feature files of the database: {files}')
+    mean = [CONSTANTS[dataset + '_MEAN'][k] for k in features]
+    std = [CONSTANTS[dataset + '_STD'][k] for k in features]
+    return mean, std
+
+
+def __getattr__(name):
+    # CONSTANTS is loaded on first access, not at import
+    if name == 'CONSTANTS':
+        return get_constants()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 #sharp2smarp = np.load('datasets/sharp2smarp.npy', allow_pickle=True).item()
@@ -1,18 +1,27 @@
 import os
+import io
+import tarfile
 import functools
+import itertools
 from pathlib import Path
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 import drms
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, BatchSampler, RandomSampler, SequentialSampler
+from torch.utils.data import get_worker_info
 from torchvision.transforms import Compose
 import pytorch_lightning as pl
 
-from arnet.fusion import get_datasets
-from arnet.transforms import get_transform
-from arnet.utils import query_images, query_parameters, read_header
-from arnet.constants import CONSTANTS
+from arnet.fusion import get_datasets, load_database
+from arnet.transforms import get_transform, get_transform_hash, CenterCropPad
+from arnet.embeddings import EmbeddingDataset, load_backbone, compute_embeddings, get_embedding_dim
+from arnet.image_features import IMAGE_FEATURES
+from arnet.sequence_features import SEQUENCE_FEATURES
+from arnet.utils import query_images, query_parameters, read_header, PredictionHistory
+from arnet.constants import get_feature_stats
+from arnet.config import add_missing_defaults
 
 
 DATA_DIRS = {
@@ -23,6 +32,19 @@ SERIES = {
     'HARP': 'hmi.sharp_cea_720s',
     'TARP': 'mdi.smarp_cea_96m',
 }
+# Columns of feature files (merged by arnet.fusion.load_database)
+SAMPLE_FEATURES = IMAGE_FEATURES + SEQUENCE_FEATURES
+# Transforms that change the spatial size. Skipped in bucketing mode.
+SPATIAL_TRANSFORMS = ['Resize', 'FrameResize', 'CenterCropPad']
+
+
+def split_parameters(parameters):
+    """Header keywords (queried per frame) and columns of feature files (per
+    sample, repeated along time) among `parameters`, in this order.
+    """
+    columns = [f for f in parameters if f in SAMPLE_FEATURES]
+    keywords = [f for f in parameters if f not in columns]
+    return keywords, columns
 
 
 def imputed_indices(invalid, length, method='bfill'):
@@ -50,6 +72,40 @@ def imputed_indices(invalid, length, method='bfill'):
     return indices
 
 
+def bfill_windows(arr):
+    """Backward-fill nan entries along the time axis of a [N, T, F] array."""
+    arr = arr.copy()
+    for t in range(arr.shape[1] - 2, -1, -1):
+        invalid = np.isnan(arr[:, t])
+        arr[:, t][invalid] = arr[:, t + 1][invalid]
+    return arr
+
+
+def load_parameter_windows(df_sample, parameters, num_frames=16, num_frames_after=0):
+    """Load the keyword sequences of all samples at once.
+
+    Each header file is read once and reindexed at the T_REC of all windows
+    of that active region, instead of one Redis query per sample.
+
+    Returns:
+        windows: Array of shape [N, T, F] in the order of `df_sample`.
+    """
+    dt = np.timedelta64(96, 'm')
+    offsets = np.arange(-(num_frames - 1), num_frames_after + 1) * dt
+    windows = np.full((len(df_sample), len(offsets), len(parameters)), np.nan)
+    df_sample = df_sample.reset_index(drop=True) # index = position
+    for (prefix, arpnum), group in df_sample.groupby(['prefix', 'arpnum']):
+        dataset = 'sharp' if prefix == 'HARP' else 'smarp'
+        header = read_header(dataset, arpnum, index_col='T_REC')[parameters]
+        header = header[~header.index.duplicated()]
+        t_ends = pd.to_datetime(group['t_end']).to_numpy()
+        t_recs = pd.DatetimeIndex((t_ends[:, None] + offsets[None, :]).ravel())
+        t_recs = t_recs.strftime('%Y.%m.%d_%H:%M:%S_TAI')
+        values = header.reindex(t_recs).to_numpy(dtype=float)
+        windows[group.index] = values.reshape(len(group), len(offsets), len(parameters))
+    return bfill_windows(windows)
+
+
 class ActiveRegionDataset(Dataset):
     """Active Region dataset.
 
@@ -58,19 +114,28 @@ class ActiveRegionDataset(Dataset):
         features: List of features to use. If None, use magnetogram.
         num_frames: Number of frames before t_end to use.
         transforms (callable): Transform to apply to samples.
+        cache_dir: If given, transformed videos are cached there as float16.
+            The directory must be specific to the transform (see
+            `get_transform_hash`).
+        database: Database of the samples, whose feature statistics
+            standardize the parameters. Defaults to ARNET_PROCESSED_DATA_DIR.
     """
-    def __init__(self, df_sample, features=None, num_frames=16, num_frames_after=0, transform=None):
+    def __init__(self, df_sample, features=None, num_frames=16, num_frames_after=0, transform=None,
+                 cache_dir=None, database=None):
         # Default values and assertions
         features = features or ['MAGNETOGRAM']
         assert 1 <= num_frames <= 16, 'num_frames not in [1,16]'
 
         self.df_sample = df_sample
-        self.parameters = [f for f in features if f != 'MAGNETOGRAM']
+        self.keywords, self.columns = split_parameters([f for f in features if f != 'MAGNETOGRAM'])
+        self.parameters = self.keywords + self.columns # order of the last axis
         self.yield_video = 'MAGNETOGRAM' in features
         self.yield_parameters = len(self.parameters) > 0
         self.num_frames = num_frames
         self.num_frames_after = num_frames_after
         self.transform = transform
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.database = database
 
     def __len__(self):
         return len(self.df_sample)
@@ -85,21 +150,25 @@ class ActiveRegionDataset(Dataset):
             data_list.append(video)
             data_list.append(size)
         if self.yield_parameters:
-            parameters = self.load_parameters(s['prefix'], s['arpnum'], s['t_end'])
+            parameters = self.load_parameters(s)
             data_list.append(parameters)
 
 
         # label
         label = int(s['label'])
 
-        # meta
-        t_end = datetime.strptime(s['t_end'], '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d%H%M%S')
-        largest_flare = max(s['flares'].split('|')) #WARNING: X10+
-        meta = f'{idx}_{s["prefix"]}{s["arpnum"]:06d}_{t_end}_H0_W0_{largest_flare}.npy'
-        return (*data_list, label, meta)
+        # meta: sample id, i.e., position in df_sample
+        return (*data_list, label, idx)
 
-    def load_video(self, prefix, arpnum, t_now, bad_img_idx):
-        t_now = drms.to_datetime(t_now)
+    def get_cache_path(self, prefix, arpnum, t_now):
+        filename = f"{t_now.strftime('%Y%m%d_%H%M%S')}_{self.num_frames}_{self.num_frames_after}.pt"
+        return self.cache_dir / f'{prefix}{arpnum:06d}' / filename
+
+    def get_filepaths(self, prefix, arpnum, t_now, bad_img_idx):
+        """Magnetogram files of the frames of a sample, with bad frames imputed.
+
+        `t_now` is a datetime, e.g., `drms.to_datetime(s['t_end'])`.
+        """
         dt = timedelta(minutes=96)
         t_start = t_now - dt * (self.num_frames - 1)
         t_end = t_now + dt * self.num_frames_after
@@ -109,6 +178,17 @@ class ActiveRegionDataset(Dataset):
         indices = imputed_indices(bad_img_idx, len(filenames))
         filepaths = [os.path.join(DATA_DIRS[prefix], f'{arpnum:06d}', filenames[k])
                      for k in indices]
+        return filepaths
+
+    def load_video(self, prefix, arpnum, t_now, bad_img_idx):
+        t_now = drms.to_datetime(t_now)
+        if self.cache_dir:
+            cache_path = self.get_cache_path(prefix, arpnum, t_now)
+            if cache_path.exists():
+                video, size = torch.load(cache_path)
+                return video.float(), size
+
+        filepaths = self.get_filepaths(prefix, arpnum, t_now, bad_img_idx)
         video = query_images(filepaths)
         video = torch.from_numpy(video)
         video = torch.unsqueeze(video, 0) # C,T,H,W
@@ -117,16 +197,30 @@ class ActiveRegionDataset(Dataset):
         size /= torch.tensor([38, 78])
         if self.transform:
             video = self.transform(video)
+        if self.cache_dir:
+            # Round to float16 as cached, so that cache misses and hits give the same inputs
+            video = video.half()
+            # Write to a temporary file first: other workers may read the same sample
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+            torch.save((video, size), tmp_path)
+            os.replace(tmp_path, cache_path)
+            video = video.float()
         return video, size
 
-    def load_parameters(self, prefix, arpnum, t_now):
-        t_now = datetime.strptime(t_now, '%Y-%m-%d %H:%M:%S') #2013-07-03 01:36:00
+    def load_parameters(self, s):
+        """Parameter sequence of sample `s`, a row of `df_sample`."""
+        t_now = datetime.strptime(s['t_end'], '%Y-%m-%d %H:%M:%S') #2013-07-03 01:36:00
         dt = timedelta(minutes=96)
         t_start = t_now - dt * (self.num_frames - 1)
         t_end = t_now + dt * self.num_frames_after
         t_recs = pd.date_range(t_start, t_end, freq='96min').strftime('%Y.%m.%d_%H:%M:%S_TAI')
-        df = query_parameters(prefix, arpnum, t_recs, self.parameters)
-        df = df.fillna(method='bfill')
+        df = pd.DataFrame(index=t_recs)
+        if self.keywords:
+            df = query_parameters(s['prefix'], s['arpnum'], t_recs, self.keywords)
+            df = df.fillna(method='bfill')
+        # Columns of feature files are per sample and repeated along time
+        df = df.assign(**{c: float(s[c]) for c in self.columns})
 
         # Check na is time consuming. If na, loss will be nan
         #if df.isna().any(axis=None):
@@ -135,7 +229,7 @@ class ActiveRegionDataset(Dataset):
 
         #if self.transform:
         #    df = self.transform(df)
-        df = self.standardize(df, prefix)
+        df = self.standardize(df, s['prefix'])
         sequence = torch.tensor(df.to_numpy(), dtype=torch.float32) # float16 causes error, lstm is 32bit
         return sequence
         #sequence = standardize(prefix, sequence).astype(np.float32)
@@ -147,12 +241,357 @@ class ActiveRegionDataset(Dataset):
             dataset = 'SMARP'
         else:
             raise
-        mean = [v for k, v in CONSTANTS[dataset + '_MEAN'].items() if k in self.parameters]
-        std = [v for k, v in CONSTANTS[dataset + '_STD'].items() if k in self.parameters]
+        mean, std = get_feature_stats(dataset, self.parameters, self.database)
         df[self.parameters] = (df.values - mean) / std  # runtime: arr - arr < df - arr
         return df
 
 
+class ActiveRegionTensorDataset(Dataset):
+    """Keyword sequences of all samples materialized in one tensor.
+
+    Only for parameter features (no magnetogram). Columns of feature files
+    (e.g., arnet.sequence_features) are repeated along time. Sequences are
+    standardized once at construction. The dataset is indexed with a list of indices and
+    returns a whole batch, so it is used with a `BatchSampler` and
+    `batch_size=None` (see `get_batch_dataloader`).
+
+    Args:
+        df_sample: Sample data frame.
+        features: List of parameter features.
+        num_frames: Number of frames before t_end to use.
+        database: Database of the samples, whose feature statistics
+            standardize the parameters. Defaults to ARNET_PROCESSED_DATA_DIR.
+    """
+    def __init__(self, df_sample, features, num_frames=16, num_frames_after=0, database=None):
+        assert 'MAGNETOGRAM' not in features, 'Tensor dataset only supports parameters'
+        self.df_sample = df_sample
+        self.database = database
+        keywords, columns = split_parameters(features)
+        self.parameters = keywords + columns # order of the last axis
+        num_steps = num_frames + num_frames_after
+        windows = np.zeros((len(df_sample), num_steps, 0))
+        if keywords:
+            windows = load_parameter_windows(df_sample, keywords,
+                                             num_frames=num_frames,
+                                             num_frames_after=num_frames_after)
+        values = df_sample[columns].to_numpy(dtype=float)
+        windows = np.concatenate([windows, np.repeat(values[:, None], num_steps, axis=1)], axis=-1)
+        windows = self.standardize(windows, df_sample['prefix'].to_numpy())
+        self.x = torch.tensor(windows, dtype=torch.float32) # [N, T, F]
+        self.y = torch.tensor(df_sample['label'].to_numpy(dtype=int), dtype=torch.long)
+
+    def __len__(self):
+        return len(self.df_sample)
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        return self.x[indices], self.y[indices], indices
+
+    def standardize(self, windows, prefixes):
+        for prefix, dataset in [('HARP', 'SHARP'), ('TARP', 'SMARP')]:
+            mask = prefixes == prefix
+            mean, std = map(np.array, get_feature_stats(dataset, self.parameters, self.database))
+            windows[mask] = (windows[mask] - mean) / std
+        return windows
+
+
+SHARD_INDEX = 'index.csv'
+SHARD_KEYS = ['prefix', 'arpnum', 't_end'] # identify samples in the index
+
+
+def write_shards(dataset, shard_dir, shard_size=1000, num_workers=0):
+    """Pack the samples of an `ActiveRegionDataset` into tar shards.
+
+    Samples are read in order (in parallel with `num_workers`) and written
+    sequentially, `shard_size` samples per shard, as `shard-{k:05d}.tar`
+    with one `{idx:08d}.pt` member per sample. `index.csv` lists the shard
+    of each sample along with `SHARD_KEYS`.
+    """
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+    index = dataset.df_sample[SHARD_KEYS].reset_index(drop=True)
+    index['shard'] = [f'shard-{k:05d}.tar' for k in np.arange(len(index)) // shard_size]
+    tar = None
+    for idx, sample in enumerate(loader):
+        if idx % shard_size == 0:
+            if tar is not None:
+                tar.close()
+            tar = tarfile.open(shard_dir / index['shard'].iat[idx], 'w')
+        buffer = io.BytesIO()
+        torch.save(sample, buffer)
+        info = tarfile.TarInfo(f'{idx:08d}.pt')
+        info.size = buffer.tell()
+        buffer.seek(0)
+        tar.addfile(info, buffer)
+    if tar is not None:
+        tar.close()
+    index.to_csv(shard_dir / SHARD_INDEX, index=False)
+    return index
+
+
+class ShardedActiveRegionDataset(IterableDataset):
+    """Stream samples from tar shards written by `write_shards`.
+
+    Shards are read sequentially. Each worker reads a disjoint subset of
+    shards, in a random order per epoch if `shuffle`, and samples are
+    shuffled within a bounded buffer.
+
+    The shuffle of an epoch is seeded by `seed` and the epoch, so it is the
+    same in all workers and processes. As with `DistributedSampler`, call
+    `set_epoch` before the iterator of each epoch is created. It updates the
+    epoch in shared memory, seen by persistent workers too.
+
+    In distributed training, shards are split among the workers of all
+    `num_replicas` processes. Every worker stops at the sample count of the
+    smallest split, so that all processes yield the same number of batches.
+
+    Args:
+        shard_dir: Directory with the shards and `index.csv`.
+        df_sample: If given, the index is checked to list the samples of
+            `df_sample` in the same order, so that the sample ids match.
+        shuffle: Shuffle shards and samples.
+        buffer_size: Number of samples in the shuffle buffer.
+        num_replicas: Number of processes of distributed training.
+        rank: Rank of this process.
+        seed: Base seed of the shuffle.
+    """
+    def __init__(self, shard_dir, df_sample=None, shuffle=False, buffer_size=1000,
+                 num_replicas=1, rank=0, seed=0):
+        self.shard_dir = Path(shard_dir)
+        index = pd.read_csv(self.shard_dir / SHARD_INDEX)
+        if df_sample is not None:
+            expected = df_sample[SHARD_KEYS].reset_index(drop=True)
+            if not index[SHARD_KEYS].astype(str).equals(expected.astype(str)):
+                raise ValueError(f'Shards in {shard_dir} do not match the samples. '
+                                 'Rewrite them with run_arnet.py --modes write_shards')
+        self.shards = index['shard'].drop_duplicates().tolist()
+        self.shard_sizes = index['shard'].value_counts().to_dict()
+        self.num_samples = len(index)
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = torch.zeros((), dtype=torch.int64).share_memory_() # shared with workers
+
+    def set_epoch(self, epoch):
+        self.epoch.fill_(epoch)
+
+    def __len__(self):
+        return self.num_samples // self.num_replicas
+
+    def iter_shard(self, shard):
+        with tarfile.open(self.shard_dir / shard, 'r|') as tar: # stream mode
+            for member in tar:
+                yield torch.load(io.BytesIO(tar.extractfile(member).read()))
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        seed = self.seed + int(self.epoch)
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        shards = self.shards
+        if self.shuffle:
+            rng = np.random.default_rng(seed % 2**32)
+            shards = [shards[i] for i in rng.permutation(len(shards))]
+        num_splits = num_workers * self.num_replicas
+        splits = [shards[i::num_splits] for i in range(num_splits)]
+        shards = splits[self.rank * num_workers + worker_id]
+        limit = None
+        if self.num_replicas > 1:
+            limit = min(sum(self.shard_sizes[s] for s in split) for split in splits)
+        samples = itertools.islice((sample for shard in shards for sample in self.iter_shard(shard)),
+                                   limit)
+
+        rng = np.random.default_rng((seed + self.rank * num_workers + worker_id) % 2**32)
+        buffer = []
+        for sample in samples:
+            if not self.shuffle:
+                yield sample
+                continue
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler grouping samples of similar magnetogram sizes.
+
+    Samples are bucketed by (HEIGHT, WIDTH) of the last frame, quantized by
+    `granularity` pixels, and every batch is drawn from a single bucket. With
+    `crop_collate`, batches are stacked without resizing or padding.
+
+    Args:
+        df_sample: Sample data frame with columns 'HEIGHT' and 'WIDTH'.
+        batch_size: Maximum number of samples in a batch.
+        granularity: Bucket width in pixels.
+        shuffle: Shuffle samples within buckets and the order of batches.
+        drop_last: Drop the last incomplete batch of each bucket.
+    """
+    def __init__(self, df_sample, batch_size, granularity=8, shuffle=False, drop_last=False):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        keys = (df_sample[['HEIGHT', 'WIDTH']].to_numpy(dtype=int) // granularity)
+        _, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        self.buckets = [np.where(inverse == k)[0] for k in range(inverse.max() + 1)]
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = bucket[torch.randperm(len(bucket)).numpy()]
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    break
+                batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(b) // self.batch_size for b in self.buckets)
+        return sum(-(-len(b) // self.batch_size) for b in self.buckets)
+
+
+def get_dist_info():
+    """Rank and number of processes of distributed training, or (0, 1)."""
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+class DistributedBatchSampler(Sampler):
+    """Split the batches of a batch sampler among the processes of
+    distributed training.
+
+    Every process draws the same batches, with the random state seeded by
+    `seed` and the epoch (see `set_epoch`), and process `rank` takes every
+    `num_replicas`-th batch. Unlike `DistributedSampler`, this works with any batch sampler,
+    e.g., `BucketBatchSampler` or batches of `ActiveRegionTensorDataset`.
+
+    Args:
+        drop_last: Drop the last batches so that all processes get the same
+            number of batches, as required in training.
+    """
+    def __init__(self, batch_sampler, num_replicas, rank, seed=0, drop_last=False):
+        self.batch_sampler = batch_sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed + self.epoch)
+            batches = list(self.batch_sampler)
+        if self.drop_last:
+            batches = batches[:len(batches) // self.num_replicas * self.num_replicas]
+        return iter(batches[self.rank::self.num_replicas])
+
+    def __len__(self):
+        num_batches = len(self.batch_sampler)
+        if self.drop_last:
+            return num_batches // self.num_replicas
+        return len(range(self.rank, num_batches, self.num_replicas))
+
+
+def distribute_batch_sampler(batch_sampler, seed=0, drop_last=False):
+    """Wrap `batch_sampler` in a `DistributedBatchSampler` in distributed training."""
+    rank, world_size = get_dist_info()
+    if world_size == 1:
+        return batch_sampler
+    return DistributedBatchSampler(batch_sampler, world_size, rank, seed=seed, drop_last=drop_last)
+
+
+_SHARED_BUFFERS = {} # (field, shape, dtype) -> ring of shared-memory batch buffers of a worker
+
+
+def get_shared_buffer(key, shape, dtype, num_buffers):
+    """Next buffer of a ring of `num_buffers` shared-memory tensors of this
+    worker process. The oldest buffer is reused once the ring is full.
+    """
+    ring = _SHARED_BUFFERS.setdefault(key, [])
+    if len(ring) < num_buffers:
+        buffer = torch.empty(shape, dtype=dtype).share_memory_()
+    else:
+        buffer = ring.pop(0)
+    ring.append(buffer)
+    return buffer
+
+
+def shared_collate(batch, num_buffers=0):
+    """Collate a list of sample tuples into a tuple of batch tensors.
+
+    Inside a worker, every tensor field is stacked directly into a buffer in
+    shared memory, so the batch reaches the main process without another
+    copy. Labels and sample ids become int64 tensors. Unlike
+    `default_collate`, there is no recursive type dispatch per sample.
+
+    Args:
+        num_buffers: If positive, buffers are recycled from a ring of this
+            many per field and batch shape, instead of allocated per batch.
+            Only safe if the main process releases a batch before the ring
+            comes around, see `ActiveRegionDataModule.get_collate_fn`.
+    """
+    in_worker = get_worker_info() is not None
+    collated = []
+    for i, field in enumerate(zip(*batch)):
+        elem = field[0]
+        if isinstance(elem, torch.Tensor):
+            out = None
+            if in_worker and num_buffers > 0:
+                shape = (len(field), *elem.shape)
+                out = get_shared_buffer((i, shape, elem.dtype), shape, elem.dtype, num_buffers)
+            elif in_worker:
+                numel = len(field) * elem.numel()
+                storage = elem.storage()._new_shared(numel)
+                out = elem.new(storage).resize_(len(field), *elem.shape)
+            collated.append(torch.stack(field, 0, out=out))
+        else:
+            collated.append(torch.tensor(field, dtype=torch.long))
+    return tuple(collated)
+
+
+def crop_collate(batch):
+    """Collate videos of a size bucket by center-cropping to the smallest size.
+
+    Batch shapes vary with the bucket, so buffers are not recycled.
+    """
+    h = min(sample[0].shape[-2] for sample in batch)
+    w = min(sample[0].shape[-1] for sample in batch)
+    crop = CenterCropPad((None, h, w), pad=False)
+    batch = [(crop(sample[0]), *sample[1:]) for sample in batch]
+    return shared_collate(batch)
+
+
+def get_batch_dataloader(dataset, batch_size, shuffle=False, drop_last=False, seed=0):
+    """DataLoader over a dataset that returns whole batches by index lists."""
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    batch_sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+    batch_sampler = distribute_batch_sampler(batch_sampler, seed=seed, drop_last=drop_last)
+    dataloader = DataLoader(dataset,
+                            sampler=batch_sampler,
+                            batch_size=None, # batches come from the dataset
+                            num_workers=0)
+    return dataloader
+
+
 class ActiveRegionDataModule(pl.LightningDataModule):
     """Active region DataModule.
 
@@ -160,15 +599,25 @@ class ActiveRegionDataModule(pl.LightningDataModule):
     """
     def __init__(self, cfg):
         super().__init__()
-        self.cfg = cfg
+        self.cfg = add_missing_defaults(cfg) # e.g., the config of an earlier checkpoint
         self._construct_transforms()
         self._construct_datasets(balanced=cfg.DATA.BALANCED)
         self.testmode = 'test'
+        self.in_memory = cfg.DATA.IN_MEMORY and 'MAGNETOGRAM' not in cfg.DATA.FEATURES
+        self._tensor_datasets = {} # split name -> ActiveRegionTensorDataset
+        if cfg.DATA.EMBEDDING_DIR and os.path.exists(cfg.DATA.EMBEDDING_DIR):
+            cfg.LEARNER.MODEL.INPUT_SIZE = get_embedding_dim(cfg.DATA.EMBEDDING_DIR)
 
     def _construct_transforms(self):
+        names = self.cfg.DATA.TRANSFORMS
+        if self.cfg.DATA.BUCKETING:
+            names = [name for name in names if name not in SPATIAL_TRANSFORMS]
         transforms = [get_transform(name, self.cfg)
-                      for name in self.cfg.DATA.TRANSFORMS]
+                      for name in names]
         self.transform = Compose(transforms)
+        # After get_transform, which sets IMAGE_MEAN and IMAGE_STD
+        self.cache_dir = (os.path.join(self.cfg.DATA.CACHE_DIR, get_transform_hash(self.cfg))
+                          if self.cfg.DATA.CACHE_DIR else None)
 
     def _construct_datasets(self, balanced=True):
         df_train, df_val, df_test = get_datasets(
@@ -180,6 +629,8 @@ class ActiveRegionDataModule(pl.LightningDataModule):
             seed=self.cfg.DATA.SEED,
             val_split=getattr(self.cfg.DATA, 'VAL_SPLIT', None),
             test_split=getattr(self.cfg.DATA, 'TEST_SPLIT', None),
+            criterion=self.cfg.DATA.CRITERION,
+            horizon=self.cfg.DATA.HORIZON,
         )
         df_vals = [df_val, df_test]
 
@@ -191,36 +642,159 @@ class ActiveRegionDataModule(pl.LightningDataModule):
 
         # Prediction results
         self.val_history = {
-            f'validation{i}': df.copy()
+            f'validation{i}': PredictionHistory(df)
             for i, df in enumerate(self.df_vals)
         }
-        self.val_history['test'] = self.df_test.copy() # learner.py: fill_prob in test_epoch_end()
+        self.val_history['test'] = PredictionHistory(self.df_test) # learner.py: fill_prob in test_epoch_end()
 
     def set_class_weight(self, cfg):
         p = self.df_train['label'].mean()
         cfg.DATA.CLASS_WEIGHT = [1-p, p]
         return cfg
 
-    def fill_prob(self, tag, global_step, probs):
-        import numpy as np
-        df = self.val_history[tag]
-        probs = [probs[i] if i < len(probs) else np.nan for i in range(len(df))]
-        df[f'step-{global_step}'] = probs
+    def fill_prob(self, tag, global_step, probs, ids=None):
+        self.val_history[tag].append(global_step, probs, ids=ids)
+
+    def get_tensor_dataset(self, df_sample):
+        """In-memory dataset of `df_sample`. Datasets of the splits of the
+        DataModule are kept, by split name, for later epochs and loaders.
+        """
+        splits = {'train': self.df_train, 'validation': self.df_vals[0], 'test': self.df_test}
+        name = next((name for name, df in splits.items() if df is df_sample), None)
+        if name in self._tensor_datasets:
+            return self._tensor_datasets[name]
+        dataset = ActiveRegionTensorDataset(
+            df_sample,
+            features=self.cfg.DATA.FEATURES,
+            num_frames=self.cfg.DATA.NUM_FRAMES,
+            database=self.cfg.DATA.DATABASE)
+        if name is not None:
+            self._tensor_datasets[name] = dataset
+        return dataset
+
+    def get_worker_kwargs(self):
+        kwargs = {
+            'num_workers': self.cfg.DATA.NUM_WORKERS,
+            'pin_memory': True,
+        }
+        if self.cfg.DATA.NUM_WORKERS > 0: # only valid with worker processes
+            kwargs['prefetch_factor'] = self.cfg.DATA.PREFETCH_FACTOR
+            kwargs['persistent_workers'] = self.cfg.DATA.PERSISTENT_WORKERS
+        return kwargs
+
+    def get_collate_fn(self):
+        """`shared_collate`, recycling batch buffers when it is safe.
+
+        With pinned memory, the main process copies every batch out of shared
+        memory as it arrives, so a worker has at most PREFETCH_FACTOR batches
+        in flight plus one being pinned. A ring of PREFETCH_FACTOR + 2 buffers
+        is then never overwritten while in use. Without pinning, the training
+        step holds the shared batch itself, and buffers are allocated per batch.
+        """
+        kwargs = self.get_worker_kwargs()
+        if kwargs['num_workers'] > 0 and kwargs['pin_memory'] and torch.cuda.is_available():
+            return functools.partial(shared_collate, num_buffers=self.cfg.DATA.PREFETCH_FACTOR + 2)
+        return shared_collate
+
+    def get_batch_sampler(self, dataset, shuffle=False, drop_last=False):
+        """Batch sampler of the loader settings, split among processes in
+        distributed training.
+        """
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        batch_sampler = BatchSampler(sampler, batch_size=self.cfg.DATA.BATCH_SIZE, drop_last=drop_last)
+        return distribute_batch_sampler(batch_sampler, seed=self.cfg.DATA.SEED or 0, drop_last=drop_last)
 
     def get_dataloader(self, df_sample, shuffle=False, drop_last=False):
-        dataset = ActiveRegionDataset(df_sample,
-                                      features=self.cfg.DATA.FEATURES,
-                                      num_frames=self.cfg.DATA.NUM_FRAMES,
-                                      transform=self.transform)
+        if self.cfg.DATA.EMBEDDING_DIR:
+            dataset = EmbeddingDataset(self.get_dataset(df_sample), self.cfg.DATA.EMBEDDING_DIR)
+            return DataLoader(dataset,
+                              batch_sampler=self.get_batch_sampler(dataset, shuffle, drop_last),
+                              collate_fn=self.get_collate_fn(),
+                              **self.get_worker_kwargs())
+
+        if self.in_memory:
+            dataset = self.get_tensor_dataset(df_sample)
+            return get_batch_dataloader(dataset,
+                                        batch_size=self.cfg.DATA.BATCH_SIZE,
+                                        shuffle=shuffle,
+                                        drop_last=drop_last,
+                                        seed=self.cfg.DATA.SEED or 0)
+
+        dataset = self.get_dataset(df_sample)
+        if self.cfg.DATA.BUCKETING and dataset.yield_video:
+            batch_sampler = BucketBatchSampler(df_sample,
+                                               batch_size=self.cfg.DATA.BATCH_SIZE,
+                                               granularity=self.cfg.DATA.BUCKET_GRANULARITY,
+                                               shuffle=shuffle,
+                                               drop_last=drop_last)
+            batch_sampler = distribute_batch_sampler(batch_sampler, seed=self.cfg.DATA.SEED or 0,
+                                                     drop_last=drop_last)
+            dataloader = DataLoader(dataset,
+                                    batch_sampler=batch_sampler,
+                                    collate_fn=crop_collate,
+                                    **self.get_worker_kwargs())
+            return dataloader
+
+        dataloader = DataLoader(dataset,
+                                batch_sampler=self.get_batch_sampler(dataset, shuffle, drop_last),
+                                collate_fn=self.get_collate_fn(),
+                                **self.get_worker_kwargs())
+        return dataloader
+
+    def get_dataset(self, df_sample):
+        return ActiveRegionDataset(df_sample,
+                                   features=self.cfg.DATA.FEATURES,
+                                   num_frames=self.cfg.DATA.NUM_FRAMES,
+                                   transform=self.transform,
+                                   cache_dir=self.cache_dir,
+                                   database=self.cfg.DATA.DATABASE)
+
+    def get_shard_dataloader(self, df_sample):
+        rank, world_size = get_dist_info()
+        dataset = ShardedActiveRegionDataset(self.cfg.DATA.SHARD_DIR,
+                                             df_sample=df_sample,
+                                             shuffle=True,
+                                             buffer_size=self.cfg.DATA.SHUFFLE_BUFFER,
+                                             num_replicas=world_size,
+                                             rank=rank,
+                                             seed=self.cfg.DATA.SEED or 0)
         dataloader = DataLoader(dataset,
                                 batch_size=self.cfg.DATA.BATCH_SIZE,
-                                shuffle=shuffle,
-                                drop_last=drop_last,
-                                num_workers=self.cfg.DATA.NUM_WORKERS,
-                                pin_memory=True)
+                                drop_last=True,
+                                collate_fn=self.get_collate_fn(),
+                                **self.get_worker_kwargs())
         return dataloader
 
+    def write_shards(self):
+        """Write the training samples into shards in cfg.DATA.SHARD_DIR."""
+        return write_shards(self.get_dataset(self.df_train),
+                            self.cfg.DATA.SHARD_DIR,
+                            shard_size=self.cfg.DATA.SHARD_SIZE,
+                            num_workers=self.cfg.DATA.NUM_WORKERS)
+
+    def compute_embeddings(self):
+        """Embed the frames of every sample of the database with the backbone
+        in cfg.DATA.EMBEDDING_CHECKPOINT and write them to cfg.DATA.EMBEDDING_DIR.
+
+        All samples are embedded, not only those of the current split and
+        undersampling, so that head-only runs with any DATA.SEED, split,
+        BALANCED or CRITERION share the embeddings.
+        """
+        backbone = load_backbone(self.cfg.DATA.EMBEDDING_CHECKPOINT)
+        df_smarp, df_sharp = load_database(self.cfg.DATA.DATABASE, self.cfg.DATA.AUXDATA)
+        embeddings = compute_embeddings(self.get_dataset(self.df_train),
+                                        [df_smarp, df_sharp],
+                                        backbone,
+                                        self.cfg.DATA.EMBEDDING_DIR,
+                                        batch_size=self.cfg.DATA.BATCH_SIZE,
+                                        num_workers=self.cfg.DATA.NUM_WORKERS,
+                                        device='cuda' if torch.cuda.is_available() else 'cpu')
+        self.cfg.LEARNER.MODEL.INPUT_SIZE = embeddings.shape[1]
+        return embeddings
+
     def train_dataloader(self):
+        if self.cfg.DATA.SHARD_DIR:
+            return self.get_shard_dataloader(self.df_train)
         loader = self.get_dataloader(self.df_train, shuffle=True, drop_last=True)
         return loader
 
@@ -0,0 +1,160 @@
+"""Per-frame embeddings of a frozen backbone.
+
+Every magnetogram of a database is passed once through the convolutional
+stack of a trained model and the flattened outputs are stored in a
+memory-mapped array. Temporal heads (e.g., SimpleLSTM) are then trained on
+sequences of embeddings with `EmbeddingDataset`, without loading images.
+
+Layout of an embedding directory:
+    embeddings.npy: float16 array of shape [num_frames, dim] (np.memmap).
+    frames.csv: Magnetogram file path of each row.
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import drms
+import torch
+from torch import nn
+from torch.utils.data import Dataset, DataLoader
+
+from arnet.utils import query_images
+
+
+EMBEDDING_FILE = 'embeddings.npy'
+FRAME_FILE = 'frames.csv'
+
+
+def load_backbone(checkpoint):
+    """Frozen convolutional stack of a Learner checkpoint.
+
+    The backbone must be frame-wise, i.e., with temporal kernel and pooling
+    sizes of 1 (e.g., LEARNER.MODEL.SETTINGS 'cnn' or 'cnn_li2020'). The
+    adaptive pooling of LEARNER.MODEL.ADAPTIVE_POOL resizes the time axis to
+    that of NUM_FRAMES, which would repeat a single frame, so it is made to
+    keep the time axis as is.
+    """
+    from arnet.modeling.learner import Learner
+    learner = Learner.load_from_checkpoint(checkpoint)
+    backbone = learner.model.convs
+    for name, module in backbone.named_modules():
+        if isinstance(module, (nn.Conv3d, nn.MaxPool3d)):
+            size = module.kernel_size
+            size = size[0] if isinstance(size, tuple) else size
+            if size != 1:
+                raise ValueError(f'{name} mixes frames (temporal size {size}), '
+                                 'per-frame embeddings need a frame-wise backbone')
+        elif isinstance(module, nn.AdaptiveAvgPool3d):
+            module.output_size = (None, *module.output_size[1:])
+    backbone.eval()
+    for p in backbone.parameters():
+        p.requires_grad_(False)
+    return backbone
+
+
+def get_sample_filepaths(dataset, df_sample):
+    """Magnetogram files of the frames of each sample."""
+    return [dataset.get_filepaths(s.prefix, s.arpnum, drms.to_datetime(s.t_end), s.bad_img_idx)
+            for s in df_sample.itertuples()]
+
+
+class FrameDataset(Dataset):
+    """Single transformed frames of shape [C=1, T=1, H, W]."""
+    def __init__(self, filepaths, transform=None):
+        self.filepaths = filepaths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.filepaths)
+
+    def __getitem__(self, idx):
+        frame = torch.from_numpy(query_images([self.filepaths[idx]]))
+        frame = torch.unsqueeze(frame, 0) # C,T,H,W
+        if self.transform:
+            frame = self.transform(frame)
+        return frame
+
+
+@torch.no_grad()
+def compute_embeddings(dataset, df_samples, backbone, embedding_dir,
+                       batch_size=64, num_workers=0, device='cpu'):
+    """Embed every frame used by the samples and write an embedding directory.
+
+    Rows are keyed by frame file path, so any sample whose frames are covered
+    can be read, whatever the split or undersampling that selected it.
+
+    Args:
+        dataset: `ActiveRegionDataset` with the transform of the backbone.
+            Defines the frames of a sample.
+        df_samples: List of sample data frames, e.g., the full smarp and sharp
+            tables of a database. Frames shared by samples (overlapping
+            windows) are embedded once.
+        backbone: Module mapping [N, 1, 1, H, W] to [N, ...].
+        embedding_dir: Output directory.
+    """
+    filepaths = []
+    for df_sample in df_samples:
+        for paths in get_sample_filepaths(dataset, df_sample):
+            filepaths.extend(paths)
+    filepaths = list(dict.fromkeys(filepaths)) # unique, ordered
+    if not filepaths:
+        raise ValueError('No frames to embed')
+
+    loader = DataLoader(FrameDataset(filepaths, transform=dataset.transform),
+                        batch_size=batch_size,
+                        num_workers=num_workers)
+    backbone = backbone.to(device)
+    embedding_dir = Path(embedding_dir)
+    embedding_dir.mkdir(parents=True, exist_ok=True)
+    embeddings = None
+    start = 0
+    for frames in loader:
+        x = torch.flatten(backbone(frames.to(device)), 1).cpu().numpy()
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(embedding_dir / EMBEDDING_FILE, mode='w+',
+                                                   dtype=np.float16,
+                                                   shape=(len(filepaths), x.shape[1]))
+        embeddings[start:start + len(x)] = x
+        start += len(x)
+    embeddings.flush()
+    pd.DataFrame({'filepath': filepaths}).to_csv(embedding_dir / FRAME_FILE, index=False)
+    return embeddings
+
+
+def get_embedding_dim(embedding_dir):
+    embeddings = np.load(Path(embedding_dir) / EMBEDDING_FILE, mmap_mode='r')
+    return embeddings.shape[1]
+
+
+class EmbeddingDataset(Dataset):
+    """Sequences of frame embeddings of the samples.
+
+    Only row indices are kept in memory. Embeddings are read from the
+    memory-mapped array.
+
+    Args:
+        dataset: `ActiveRegionDataset` defining the frames of the samples.
+        embedding_dir: Directory written by `compute_embeddings`.
+    """
+    def __init__(self, dataset, embedding_dir):
+        embedding_dir = Path(embedding_dir)
+        self.df_sample = dataset.df_sample
+        self.embedding_file = embedding_dir / EMBEDDING_FILE
+        self.embeddings = None # opened in each worker
+        frames = pd.read_csv(embedding_dir / FRAME_FILE)['filepath']
+        rows = pd.Series(np.arange(len(frames)), index=frames)
+        filepaths = get_sample_filepaths(dataset, self.df_sample)
+        try:
+            self.rows = np.array([rows[paths].to_numpy() for paths in filepaths]) # [N, T]
+        except KeyError as e:
+            raise KeyError(f'Frames missing in {embedding_dir}. '
+                           'Recompute with run_arnet.py --modes embed') from e
+        self.labels = self.df_sample['label'].to_numpy(dtype=int)
+
+    def __len__(self):
+        return len(self.df_sample)
+
+    def __getitem__(self, idx):
+        if self.embeddings is None:
+            self.embeddings = np.load(self.embedding_file, mmap_mode='r')
+        x = torch.from_numpy(self.embeddings[self.rows[idx]].astype(np.float32)) # T, D
+        return x, int(self.labels[idx]), idx
@@ -1,7 +1,13 @@
 from pathlib import Path
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 
+from arnet import image_features, sequence_features
+
+# Modules writing per-sample feature files next to the datasets
+FEATURE_MODULES = [image_features, sequence_features]
+
 
 def load_csv_dataset(csv_path):
     df = pd.read_csv(csv_path, low_memory=False)
@@ -16,6 +22,26 @@ def load_fusion_dataset(auxdata):
     return d
 
 
+def load_feature_files(database, dataset, df):
+    """Add the columns of the feature files of `dataset` in `database`, if computed.
+
+    Raises:
+        ValueError: If a feature file does not match the samples of `df`.
+    """
+    for module in FEATURE_MODULES:
+        path = Path(database) / module.FEATURE_FILE.format(dataset=dataset)
+        if not path.exists():
+            continue
+        df_features = pd.read_csv(path)
+        keys = module.KEYS
+        if not df_features[keys].astype(str).equals(df[keys].reset_index(drop=True).astype(str)):
+            raise ValueError(f'{path} does not match {dataset}.csv. Recompute with '
+                             f'python -m {module.__name__} {database}')
+        features = df_features.drop(columns=keys).set_axis(df.index, axis=0)
+        df = pd.concat([df, features], axis=1)
+    return df
+
+
 def fuse_sharp_to_smarp(df, fuse_dict):
     for k, v in fuse_dict.items():
         if k in df.columns:
@@ -23,10 +49,113 @@ def fuse_sharp_to_smarp(df, fuse_dict):
     return df
 
 
-def group_split_data(df, seed=None):
+# Log intensity (see utils.get_log_intensity) of the weakest flare in a class
+FLARE_THRESHOLDS = {'C': -6., 'M': -5., 'X': -4.}
+# Evolutions kept as negative samples, see preprocess.get_label
+EVOLUTION_NEG = {
+    'Q': ['QQ'],
+    'QS': ['QQ', 'QS', 'SQ', 'SS'],
+    'QSL': ['QQ', 'QS', 'SQ', 'SS', 'LQ', 'LS'],
+}
+
+
+def get_activity(peak, thresh):
+    """Q (no flare), S (small flares), or L (large flares) of peak log intensities."""
+    return np.where(peak >= thresh, 'L', np.where(peak > -9, 'S', 'Q')).astype(object)
+
+
+def apply_criterion(df, criterion='M_Q', horizon=24):
+    """Label the samples of a master table under a criterion and a horizon.
+
+    Vectorized equivalent of preprocess.get_label on the peak intensity
+    columns `obs_peak` and `future_peak_{horizon}hr`. Discarded samples are
+    dropped.
+
+    Args:
+        df: Master table written by `preprocess.py --master`.
+        criterion: Classification criterion in the form of `threshold_negative`.
+        horizon: Prediction window in hours.
+
+    Returns:
+        df: A new data frame with `label` and `evolution` columns.
+    """
+    thresh, neg = criterion.split('_')
+    thresh = FLARE_THRESHOLDS[thresh]
+    evolution = (get_activity(df['obs_peak'].to_numpy(), thresh) +
+                 get_activity(df[f'future_peak_{horizon}hr'].to_numpy(), thresh))
+    label = np.array([e[1] == 'L' for e in evolution])
+    keep = label | np.isin(evolution, EVOLUTION_NEG[neg])
+    df = df.assign(label=label, evolution=evolution)
+    df = df[keep].reset_index(drop=True)
+    # Folds of the unlabeled table do not match the folds of the kept samples
+    return df.drop(columns=[c for c in df.columns if c == 'test_fold' or c.startswith('val_fold_')])
+
+
+def group_split_indices(df, seed=None, test_size=0.2):
+    """Positional indices of a random train/test split grouped by arpnum."""
     from sklearn.model_selection import GroupShuffleSplit
-    splitter = GroupShuffleSplit(n_splits=1, test_size=0.2, random_state=seed)
+    splitter = GroupShuffleSplit(n_splits=1, test_size=test_size, random_state=seed)
     train_idx, test_idx = next(splitter.split(df, groups=df['arpnum']))
+    return train_idx, test_idx
+
+
+def group_split_indices_cv(df, cv=5, split=0):
+    """Positional indices of the `split`-th fold of a grouped k-fold split."""
+    from sklearn.model_selection import GroupKFold
+    splitter = GroupKFold(n_splits=cv)
+    split_generator = splitter.split(df, groups=df['arpnum'])
+    for k, (train_idx, test_idx) in enumerate(split_generator):
+        if k == split:
+            return train_idx, test_idx
+
+
+def assign_cv_folds(df, cv=5):
+    """Add fold ids of the nested grouped k-fold split as columns.
+
+    Columns:
+        test_fold: Fold of the sample in GroupKFold over `df`.
+        val_fold_{k}: Fold of the sample in GroupKFold over the training part
+            when test fold k is held out. -1 for samples in test fold k.
+
+    The folds are identical to those of `group_split_indices_cv` applied to
+    `df` and then to its training part.
+    """
+    from sklearn.model_selection import GroupKFold
+    splitter = GroupKFold(n_splits=cv)
+    test_fold = np.full(len(df), -1)
+    for k, (_, test_idx) in enumerate(splitter.split(df, groups=df['arpnum'])):
+        test_fold[test_idx] = k
+    df = df.assign(test_fold=test_fold)
+    for k in range(cv):
+        train_idx = np.where(test_fold != k)[0]
+        val_fold = np.full(len(df), -1)
+        groups = df['arpnum'].iloc[train_idx]
+        for j, (_, val_idx) in enumerate(splitter.split(train_idx, groups=groups)):
+            val_fold[train_idx[val_idx]] = j
+        df[f'val_fold_{k}'] = val_fold
+    return df
+
+
+def has_cv_folds(df, cv=5):
+    return 'test_fold' in df.columns and f'val_fold_{cv - 1}' in df.columns
+
+
+def fold_split_indices(df, test_split=0, val_split=None):
+    """Positional indices of train, val (None if `val_split` is None), and
+    test samples selected by the fold columns of `assign_cv_folds`.
+    """
+    test_fold = df['test_fold'].to_numpy()
+    test_idx = np.where(test_fold == test_split)[0]
+    if val_split is None:
+        return np.where(test_fold != test_split)[0], None, test_idx
+    val_fold = df[f'val_fold_{test_split}'].to_numpy()
+    train_idx = np.where((test_fold != test_split) & (val_fold != val_split))[0]
+    val_idx = np.where(val_fold == val_split)[0]
+    return train_idx, val_idx, test_idx
+
+
+def group_split_data(df, seed=None):
+    train_idx, test_idx = group_split_indices(df, seed=seed)
     return df.iloc[train_idx], df.iloc[test_idx]
 
 
@@ -37,12 +166,8 @@ def group_split_data_cv(df, cv=5, split=0):
         split: index of the cv fold to return
     Note that GroupKFold is not random
     """
-    from sklearn.model_selection import GroupKFold
-    splitter = GroupKFold(n_splits=cv)
-    split_generator = splitter.split(df, groups=df['arpnum'])
-    for k, (train_idx, test_idx) in enumerate(split_generator):
-        if k == split:
-            return df.iloc[train_idx], df.iloc[test_idx]
+    train_idx, test_idx = group_split_indices_cv(df, cv=cv, split=split)
+    return df.iloc[train_idx], df.iloc[test_idx]
 
 
 def rus(df, balanced=False, seed=False):
@@ -73,56 +198,121 @@ def rus(df, balanced=False, seed=False):
     return df
 
 
-def get_datasets(database, dataset, auxdata,
-                 balanced=True, validation=False, shuffle=False, seed=None,
-                 val_split=0, test_split=0,
-                 balanced_test=False,
-    ):
-    """
-    Args:
-        sizes: Dict of desired class sizes. None: no rus. 'balanced': balanced rus.
-    """
+@lru_cache(maxsize=None)
+def _load_database(database, auxdata):
     df_smarp = load_csv_dataset(Path(database) / 'smarp.csv')
     df_sharp = load_csv_dataset(Path(database) / 'sharp.csv')
+    df_smarp = load_feature_files(database, 'smarp', df_smarp)
+    df_sharp = load_feature_files(database, 'sharp', df_sharp)
     fuse_dict = load_fusion_dataset(Path(auxdata))
     # Two keys are outdated. fuse_dict =
     #{'MEANGBZ': {'coef': 1.9920261748674042, 'intercept': 8.342889969768606},
     #  'USFLUX': {'coef': 1.216160520290385, 'intercept': -3.8777994451166115e+20},
     #  'R_VALUE': {'coef': 0.8327836641793915, 'intercept': -0.0945601961295528}}
     df_sharp = fuse_sharp_to_smarp(df_sharp, fuse_dict)
+    return df_smarp, df_sharp
 
-    # Cross validation split. No randomness.
+
+@lru_cache(maxsize=None)
+def _load_labeled_database(database, auxdata, criterion, horizon):
+    if criterion is None:
+        return _load_database(database, auxdata)
+    df_smarp, df_sharp = _load_database(database, auxdata)
+    # Folds over the labeled samples, as group_split_indices_cv would give
+    return (assign_cv_folds(apply_criterion(df_smarp, criterion, horizon), cv=5),
+            assign_cv_folds(apply_criterion(df_sharp, criterion, horizon), cv=5))
+
+
+def load_database(database, auxdata, criterion=None, horizon=None):
+    """Load the smarp and the fused sharp data frames of a database.
+
+    Each database is read once per process. The returned data frames are
+    shared and must not be modified in place.
+
+    Args:
+        criterion: None for a database labeled by preprocess.py. Otherwise
+            the database is a master table labeled with `apply_criterion`.
+        horizon: Prediction window in hours, used with `criterion`.
+    """
+    return _load_labeled_database(str(Path(database).resolve()), str(Path(auxdata).resolve()),
+                                  criterion, horizon)
+
+
+def _split_indices(database, auxdata, dataset, validation, seed, val_split, test_split,
+                   criterion=None, horizon=None):
+    df_smarp, df_sharp = _load_labeled_database(database, auxdata, criterion, horizon)
+    df = df_sharp if dataset in ['sharp', 'fused_sharp'] else df_smarp
+
+    val_idx = None
     if val_split is None and test_split is None:
         # This is how I split before cv was implemented
-        if dataset in ['sharp', 'fused_sharp']:
-            df_train, df_test = group_split_data(df_sharp, seed=seed)
-            if validation:
-                df_train, df_val = group_split_data(df_train, seed=seed)
-            if dataset == 'fused_sharp':
-                df_train = pd.concat((df_train, df_smarp)).reset_index(drop=True)
-        elif dataset in ['smarp', 'fused_smarp']:
-            df_train, df_test = group_split_data(df_smarp, seed=seed)
-            if validation:
-                df_train, df_val = group_split_data(df_train, seed=seed)
-            if dataset == 'fused_smarp':
-                df_train = pd.concat((df_train, df_sharp)).reset_index(drop=True)
+        train_idx, test_idx = group_split_indices(df, seed=seed)
+        if validation:
+            sub_train, sub_val = group_split_indices(df.iloc[train_idx], seed=seed)
+            train_idx, val_idx = train_idx[sub_train], train_idx[sub_val]
     else:
         # If either of them is not None, then this is after cv was implemented
         # We initialize None with 0
         val_split = val_split or 0
         test_split = test_split or 0
-        if dataset in ['sharp', 'fused_sharp']:
-            df_train, df_test = group_split_data_cv(df_sharp, cv=5, split=test_split)
-            if validation:
-                df_train, df_val = group_split_data_cv(df_train, cv=5, split=val_split)
-            if dataset == 'fused_sharp':
-                df_train = pd.concat((df_train, df_smarp)).reset_index(drop=True)
-        elif dataset in ['smarp', 'fused_smarp']:
-            df_train, df_test = group_split_data_cv(df_smarp, cv=5, split=test_split)
-            if validation:
-                df_train, df_val = group_split_data_cv(df_train, cv=5, split=val_split)
-            if dataset == 'fused_smarp':
-                df_train = pd.concat((df_train, df_sharp)).reset_index(drop=True)
+        if has_cv_folds(df, cv=5):
+            # Precomputed by assign_cv_folds
+            return fold_split_indices(df, test_split=test_split,
+                                      val_split=val_split if validation else None)
+        train_idx, test_idx = group_split_indices_cv(df, cv=5, split=test_split)
+        if validation:
+            sub_train, sub_val = group_split_indices_cv(df.iloc[train_idx], cv=5, split=val_split)
+            train_idx, val_idx = train_idx[sub_train], train_idx[sub_val]
+    return train_idx, val_idx, test_idx
+
+
+_split_indices_cached = lru_cache(maxsize=None)(_split_indices)
+
+
+def get_split_indices(database, auxdata, dataset, validation=False, seed=None,
+                      val_split=0, test_split=0, criterion=None, horizon=None):
+    """Positional indices of the train, val (None if not `validation`), and
+    test samples in the source data frame of `dataset`.
+
+    Splits are memoized per process, except random splits without a seed.
+    """
+    args = (str(Path(database).resolve()), str(Path(auxdata).resolve()),
+            dataset, validation, seed, val_split, test_split, criterion, horizon)
+    if val_split is None and test_split is None and seed is None:
+        return _split_indices(*args) # GroupShuffleSplit is random
+    return _split_indices_cached(*args)
+
+
+def get_datasets(database, dataset, auxdata,
+                 balanced=True, validation=False, shuffle=False, seed=None,
+                 val_split=0, test_split=0,
+                 balanced_test=False,
+                 criterion=None, horizon=None,
+    ):
+    """
+    Args:
+        sizes: Dict of desired class sizes. None: no rus. 'balanced': balanced rus.
+        criterion: If not None, `database` is a master table and samples are
+            labeled at load time, e.g., 'M_QS'. See `apply_criterion`.
+        horizon: Prediction window in hours, used with `criterion`.
+    """
+    assert dataset in ['sharp', 'fused_sharp', 'smarp', 'fused_smarp']
+    df_smarp, df_sharp = load_database(database, auxdata, criterion=criterion, horizon=horizon)
+    if dataset in ['sharp', 'fused_sharp']:
+        df, df_other = df_sharp, df_smarp
+    else:
+        df, df_other = df_smarp, df_sharp
+
+    # Cross validation split. No randomness.
+    train_idx, val_idx, test_idx = get_split_indices(
+        database, auxdata, dataset, validation=validation, seed=seed,
+        val_split=val_split, test_split=test_split,
+        criterion=criterion, horizon=horizon)
+    df_train, df_test = df.iloc[train_idx], df.iloc[test_idx]
+    if validation:
+        df_val = df.iloc[val_idx]
+    if dataset.startswith('fused_'):
+        df_train = pd.concat((df_train, df_other)).reset_index(drop=True)
 
     # Why rus after split? Strict ratio; Option to rus only train/test differently
     df_train = rus(df_train, balanced=balanced, seed=seed)
@@ -137,3 +327,16 @@ def get_datasets(database, dataset, auxdata,
         return df_train, df_val, df_test
     else:
         return df_train, df_test
+
+
+if __name__ == '__main__':
+    # Write cv fold ids into processed datasets, e.g.,
+    # python -m arnet.fusion datasets/M_Q_24hr datasets/M_QS_24hr
+    import sys
+    for database in sys.argv[1:]:
+        for dataset in ['smarp', 'sharp']:
+            csv_path = Path(database) / f'{dataset}.csv'
+            df = pd.read_csv(csv_path, low_memory=False)
+            df = assign_cv_folds(df, cv=5)
+            df.to_csv(csv_path, index=False)
+            print(f'{csv_path}: {len(df)} samples, fold sizes {df["test_fold"].value_counts().sort_index().tolist()}')
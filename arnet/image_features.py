@@ -0,0 +1,129 @@
+"""Physical features of the magnetograms of every sample window.
+
+Frame features are computed on stacks of frames with numpy, once per frame
+(windows of an active region overlap), in a process pool over active
+regions. Window features are the features of the last frame and their
+change over the window. They are written to
+`{database}/{dataset}_image_features.csv`, one row per sample of
+`{database}/{dataset}.csv`, and merged by `arnet.fusion.load_database`.
+
+Example:
+    python -m arnet.image_features datasets/M_Q_24hr --num_workers 16
+"""
+import argparse
+from pathlib import Path
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+
+
+FEATURE_FILE = '{dataset}_image_features.csv'
+FRAME_FEATURES = ['IMG_USFLUX', 'IMG_NETFLUX', 'IMG_MEANB', 'IMG_MEANGRAD', 'IMG_MAXGRAD',
+                  'IMG_PIL_LEN', 'IMG_PIL_FLUX']
+IMAGE_FEATURES = FRAME_FEATURES + [f'{f}_DELTA' for f in FRAME_FEATURES]
+KEYS = ['prefix', 'arpnum', 't_end'] # align features with samples
+PIL_THRESH = 150 # Gauss. Strong field on both sides of a polarity inversion line
+
+
+def frame_features(video):
+    """Features of a stack of frames.
+
+    Args:
+        video: Array of shape [T, H, W] in Gauss.
+
+    Returns:
+        features: Array of shape [T, len(FRAME_FEATURES)].
+    """
+    video = np.nan_to_num(video.astype(np.float64))
+    absb = np.abs(video)
+    gy, gx = np.gradient(video, axis=(1, 2))
+    grad = np.sqrt(gx ** 2 + gy ** 2)
+
+    # Neighboring pixels of strong opposite polarities
+    pos = video > PIL_THRESH
+    neg = video < -PIL_THRESH
+    pil_x = (pos[:, :, 1:] & neg[:, :, :-1]) | (neg[:, :, 1:] & pos[:, :, :-1])
+    pil_y = (pos[:, 1:, :] & neg[:, :-1, :]) | (neg[:, 1:, :] & pos[:, :-1, :])
+    flux_x = absb[:, :, 1:] + absb[:, :, :-1]
+    flux_y = absb[:, 1:, :] + absb[:, :-1, :]
+
+    features = np.stack([
+        absb.sum(axis=(1, 2)),
+        video.sum(axis=(1, 2)),
+        absb.mean(axis=(1, 2)),
+        grad.mean(axis=(1, 2)),
+        grad.max(axis=(1, 2)),
+        pil_x.sum(axis=(1, 2)) + pil_y.sum(axis=(1, 2)),
+        (flux_x * pil_x).sum(axis=(1, 2)) + (flux_y * pil_y).sum(axis=(1, 2)),
+    ], axis=1)
+    return features
+
+
+def window_features(frames):
+    """Features of a window from its frame features of shape [T, F]."""
+    return np.concatenate([frames[-1], frames[-1] - frames[0]])
+
+
+def region_features(windows):
+    """Features of the windows of one active region.
+
+    Frames shared by windows are read and processed once.
+
+    Args:
+        windows: List of lists of frame file paths.
+
+    Returns:
+        features: Array of shape [len(windows), len(IMAGE_FEATURES)].
+    """
+    from arnet.utils import query_images
+    cache = {}
+    features = []
+    for filepaths in windows:
+        missing = list(dict.fromkeys(f for f in filepaths if f not in cache))
+        if missing:
+            video = query_images(missing) # [T, H, W]
+            cache.update(zip(missing, frame_features(video)))
+        features.append(window_features(np.stack([cache[f] for f in filepaths])))
+    return np.stack(features)
+
+
+def extract_image_features(df, num_frames=16, num_workers=8):
+    """Image features of all samples of a processed dataset, in the order of `df`."""
+    import drms
+    from arnet.dataset import ActiveRegionDataset
+    ds = ActiveRegionDataset(df, num_frames=num_frames)
+    df = df.reset_index(drop=True)
+    groups = [group.index for _, group in df.groupby(['prefix', 'arpnum'])]
+    tasks = [[ds.get_filepaths(s.prefix, s.arpnum, drms.to_datetime(s.t_end), s.bad_img_idx)
+              for s in df.loc[index].itertuples()]
+             for index in groups]
+
+    features = np.full((len(df), len(IMAGE_FEATURES)), np.nan)
+    with Pool(num_workers) as pool:
+        for index, values in zip(groups, pool.imap(region_features, tasks)):
+            features[index] = values
+    df_features = df[KEYS].copy()
+    df_features[IMAGE_FEATURES] = features
+    return df_features
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Image features of the samples of processed datasets')
+    parser.add_argument('database', help='Directory with smarp.csv and sharp.csv')
+    parser.add_argument('--datasets', nargs='+', default=['sharp', 'smarp'])
+    parser.add_argument('--num_frames', type=int, default=16)
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+
+    from arnet.fusion import load_csv_dataset
+    for dataset in args.datasets:
+        df = load_csv_dataset(Path(args.database) / f'{dataset}.csv')
+        df_features = extract_image_features(df, num_frames=args.num_frames,
+                                             num_workers=args.num_workers)
+        path = Path(args.database) / FEATURE_FILE.format(dataset=dataset)
+        df_features.to_csv(path, index=False)
+        print(f'{path}: {len(df_features)} samples, {len(IMAGE_FEATURES)} features')
+
+
+if __name__ == '__main__':
+    main()
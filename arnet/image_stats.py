@@ -0,0 +1,195 @@
+"""Pixel statistics of the magnetograms used by a processed dataset.
+
+Frames are read in parallel and reduced to a histogram and Welford moments
+(count, mean, M2), which are merged across workers. Statistics are written
+to `{database}/{dataset}_image_stats.json` and read by `Standardize`.
+
+Example:
+    python -m arnet.image_stats datasets/M_Q_24hr --shrinkage log --thresh 150
+"""
+import json
+import argparse
+from pathlib import Path
+from multiprocessing import Pool
+import numpy as np
+import torch
+
+
+STATS_FILE = '{dataset}_image_stats.json'
+RAW = 'raw'
+
+
+def get_stats_key(shrinkage=None, thresh=None):
+    """Key of the statistics of values after ValueTransform(shrinkage, thresh)."""
+    if shrinkage is None:
+        return RAW
+    return f'{shrinkage}_{thresh}'
+
+
+def get_stats_path(database, dataset):
+    dataset = dataset.replace('fused_', '')
+    return Path(database) / STATS_FILE.format(dataset=dataset)
+
+
+def get_stats_command(database, dataset, key=RAW):
+    """Command line that computes the statistics `key` of `dataset`."""
+    cmd = f"python -m arnet.image_stats {database} --datasets {dataset.replace('fused_', '')}"
+    if key != RAW:
+        shrinkage, thresh = key.rsplit('_', 1)
+        cmd += f' --shrinkage {shrinkage} --thresh {thresh}'
+    return cmd
+
+
+def load_image_stats(database, dataset, key=RAW):
+    """Mean and std of the pixels of `dataset` in `database`."""
+    path = get_stats_path(database, dataset)
+    if not path.exists():
+        raise FileNotFoundError(f'{path} not found, Standardize needs the image statistics of the '
+                                f'dataset. Compute them with: {get_stats_command(database, dataset, key)}')
+    with open(path) as f:
+        stats = json.load(f)
+    if key not in stats:
+        raise KeyError(f'{key} statistics not in {path} (found {list(stats.keys())}). '
+                       f'Compute them with: {get_stats_command(database, dataset, key)}')
+    return stats[key]['mean'], stats[key]['std']
+
+
+def moments(x):
+    """Welford moments (count, mean, M2) of an array."""
+    n = x.size
+    if n == 0:
+        return 0, 0., 0.
+    mean = float(x.mean())
+    return n, mean, float(((x - mean) ** 2).sum())
+
+
+def merge_moments(a, b):
+    """Merge two sets of moments (Chan et al.)."""
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+    return n, mean, m2
+
+
+def get_bins(num_bins, value_range, value_transform=None):
+    """Histogram bin edges of each statistics key. Bins of value-transformed
+    pixels span the transform of [-value_range, value_range].
+    """
+    bins = {RAW: np.linspace(-value_range, value_range, num_bins + 1)}
+    if value_transform is not None:
+        key = get_stats_key(value_transform.shrinkage, value_transform.thresh)
+        lo, hi = value_transform(torch.tensor([-value_range, value_range], dtype=torch.float64)).tolist()
+        bins[key] = np.linspace(lo, hi, num_bins + 1)
+    return bins
+
+
+def frame_stats(filepaths, bins, value_transform=None):
+    """Histograms and moments of raw and value-transformed pixels of frames.
+    `bins` are the bin edges of each key, see `get_bins`.
+    """
+    from arnet.utils.data import fits_open
+    stats = {}
+    for filepath in filepaths:
+        x = np.asarray(fits_open(filepath), dtype=np.float64)
+        x = x[np.isfinite(x)]
+        values = {RAW: x}
+        if value_transform is not None:
+            key = get_stats_key(value_transform.shrinkage, value_transform.thresh)
+            values[key] = value_transform(torch.from_numpy(x)).numpy()
+        for key, v in values.items():
+            edges = bins[key]
+            hist, _ = np.histogram(np.clip(v, edges[0], edges[-1]), bins=edges)
+            if key not in stats:
+                stats[key] = {'hist': hist, 'moments': moments(v)}
+            else:
+                stats[key]['hist'] += hist
+                stats[key]['moments'] = merge_moments(stats[key]['moments'], moments(v))
+    return stats
+
+
+def _frame_stats(args):
+    return frame_stats(*args)
+
+
+def compute_image_stats(filepaths, bins, value_transform=None, num_workers=8, chunk_size=256):
+    """Statistics of all `filepaths`, computed in chunks by `num_workers` processes."""
+    chunks = [(filepaths[i:i + chunk_size], bins, value_transform)
+              for i in range(0, len(filepaths), chunk_size)]
+    total = {}
+    with Pool(num_workers) as pool:
+        for stats in pool.imap_unordered(_frame_stats, chunks):
+            for key, s in stats.items():
+                if key not in total:
+                    total[key] = s
+                else:
+                    total[key]['hist'] += s['hist']
+                    total[key]['moments'] = merge_moments(total[key]['moments'], s['moments'])
+
+    results = {}
+    for key, s in total.items():
+        n, mean, m2 = s['moments']
+        results[key] = {
+            'count': int(n),
+            'mean': mean,
+            'std': float(np.sqrt(m2 / n)),
+            'hist': s['hist'].tolist(),
+            'bins': bins[key].tolist(),
+        }
+    return results
+
+
+def get_dataset_filepaths(database, dataset, num_frames=16):
+    """Unique magnetogram files of the samples of a processed dataset."""
+    import drms
+    from arnet.fusion import load_csv_dataset
+    from arnet.dataset import ActiveRegionDataset
+    df = load_csv_dataset(Path(database) / f'{dataset}.csv')
+    ds = ActiveRegionDataset(df, num_frames=num_frames)
+    filepaths = []
+    for s in df.itertuples():
+        filepaths.extend(ds.get_filepaths(s.prefix, s.arpnum, drms.to_datetime(s.t_end), s.bad_img_idx))
+    return list(dict.fromkeys(filepaths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pixel statistics of the frames of processed datasets')
+    parser.add_argument('database', help='Directory with smarp.csv and sharp.csv')
+    parser.add_argument('--datasets', nargs='+', default=['sharp', 'smarp'])
+    parser.add_argument('--shrinkage', default=None,
+                        help='Also compute statistics after ValueTransform, e.g., log')
+    parser.add_argument('--thresh', type=float, default=150)
+    parser.add_argument('--num_frames', type=int, default=16)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--bins', type=int, default=600)
+    parser.add_argument('--range', type=float, default=3000, help='Histogram range [-range, range]')
+    args = parser.parse_args()
+
+    value_transform = None
+    if args.shrinkage is not None:
+        from arnet.transforms import ValueTransform
+        thresh = int(args.thresh) if args.thresh.is_integer() else args.thresh # match cfg.DATA.THRESH
+        value_transform = ValueTransform(shrinkage=args.shrinkage, thresh=thresh)
+    bins = get_bins(args.bins, args.range, value_transform=value_transform)
+
+    for dataset in args.datasets:
+        filepaths = get_dataset_filepaths(args.database, dataset, num_frames=args.num_frames)
+        stats = compute_image_stats(filepaths, bins, value_transform=value_transform,
+                                    num_workers=args.num_workers)
+        path = get_stats_path(args.database, dataset)
+        if path.exists():
+            # Keep statistics of other value transforms
+            with open(path) as f:
+                stats = {**json.load(f), **stats}
+        with open(path, 'w') as f:
+            json.dump(stats, f)
+        for key, s in stats.items():
+            print(f"{path} [{key}]: {s['count']} pixels, mean {s['mean']:.3f}, std {s['std']:.3f}")
+
+
+if __name__ == '__main__':
+    main()
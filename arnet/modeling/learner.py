@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 from typing import Dict, Union
 from datetime import timedelta
@@ -15,11 +16,53 @@ import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
 from arnet import utils
+from arnet.config import add_missing_defaults
 from arnet.modeling.models import build_model
 
 logger = logging.getLogger(__name__)
 
 
+# Intervals of training step diagnostics, see cfg.LEARNER.VIS
+VIS_PROFILES = {
+    'off': {
+        'HISTOGRAM_EVERY_N_STEPS': 0,
+        'META_EVERY_N_EPOCHS': 0,
+        'ACTIVATIONS_EVERY_N_STEPS': 0,
+        'VIDEO_EVERY_N_STEPS': 0,
+        'NAN_CHECK_EVERY_N_STEPS': 0,
+    },
+    'light': {
+        'HISTOGRAM_EVERY_N_STEPS': 100,
+        'META_EVERY_N_EPOCHS': 1,
+        'ACTIVATIONS_EVERY_N_STEPS': 0,
+        'VIDEO_EVERY_N_STEPS': 0,
+        'NAN_CHECK_EVERY_N_STEPS': 100,
+    },
+    'full': {
+        'HISTOGRAM_EVERY_N_STEPS': 1,
+        'META_EVERY_N_EPOCHS': 1,
+        'ACTIVATIONS_EVERY_N_STEPS': 500,
+        'VIDEO_EVERY_N_STEPS': 500,
+        'NAN_CHECK_EVERY_N_STEPS': 1,
+    },
+}
+
+
+def get_vis_schedule(cfg):
+    """Intervals of training step diagnostics of `cfg.LEARNER.VIS`, or of its profile."""
+    vis = cfg.LEARNER.VIS
+    if vis.PROFILE:
+        if vis.PROFILE not in VIS_PROFILES:
+            raise ValueError(f'Unknown LEARNER.VIS.PROFILE {vis.PROFILE}')
+        return dict(VIS_PROFILES[vis.PROFILE])
+    return {key: vis[key] for key in VIS_PROFILES['off']}
+
+
+def is_due(every, i):
+    """Whether a diagnostic scheduled every `every` steps (or epochs) runs at `i`."""
+    return every > 0 and i % every == 0
+
+
 def build_test_logger(logged_learner):
     logger = pl.loggers.TensorBoardLogger(
         logged_learner.logger_save_dir,
@@ -37,11 +80,133 @@ class Learner(pl.LightningModule):
         """
         #super(Learner, self).__init__()
         super().__init__()
-        self.cfg = cfg
-        self.image = 'MAGNETOGRAM' in cfg.DATA.FEATURES
+        # Checkpoints saved by earlier versions lack the keys added since
+        self.cfg = add_missing_defaults(cfg)
+        self.image = 'MAGNETOGRAM' in cfg.DATA.FEATURES and not cfg.DATA.EMBEDDING_DIR
         self.model = build_model(cfg)
+        self._metric_logger = None
+        self._renderer = None
+        self._syncers = {} # artifact path -> ArtifactSyncer
+        self._eval_metrics = {} # dataloader_idx or 'test' -> StreamingMetrics
+        self._member_metrics = {} # (dataloader_idx or 'test', replica) -> StreamingMetrics
+        self._member_runs = None # [(run_id, MetricLogger)] of ensemble replicas
+        self._member_best_tss = {}
+        self._best_tss = -float('inf')
+        self.vis_schedule = get_vis_schedule(cfg)
+        self.throughput_monitor = None # set by utils.ThroughputMonitor during training
         self.save_hyperparameters() # write to self.hparams. when save model, they are # responsible for tensorboard hp_metric
 
+    @property
+    def metric_logger(self):
+        """Buffered MLflow metric logger of the active run, created on first use.
+        Metrics of processes other than rank zero are discarded.
+        """
+        if self._metric_logger is None:
+            self._metric_logger = utils.MetricLogger(interval=self.cfg.LEARNER.METRIC_INTERVAL,
+                                                     enabled=self.global_rank == 0)
+        return self._metric_logger
+
+    @property
+    def renderer(self):
+        """Background figure renderer, created on first use."""
+        if self._renderer is None:
+            self._renderer = utils.FigureRenderer(num_workers=self.cfg.LEARNER.VIS.RENDER_WORKERS)
+        return self._renderer
+
+    def add_rendered_images(self, wait=False):
+        """Add figures rendered so far (or all, if `wait`) to TensorBoard."""
+        if self._renderer is None:
+            return
+        done = self._renderer.close() if wait else self._renderer.collect()
+        if wait:
+            self._renderer = None
+        for tag, image, step in done:
+            self.logger.experiment.add_image(tag, image, step)
+
+    def should_render(self, tss):
+        """Whether to render evaluation figures in this validation epoch."""
+        if self.global_rank != 0:
+            return False
+        vis = self.cfg.LEARNER.VIS
+        if vis.FIGURE_BEST_ONLY:
+            if tss <= self._best_tss:
+                return False
+            self._best_tss = tss
+            return True
+        return vis.FIGURE_EVERY_N_EPOCHS > 0 and self.current_epoch % vis.FIGURE_EVERY_N_EPOCHS == 0
+
+    @property
+    def member_runs(self):
+        """Child MLflow run id and metric logger of every ensemble replica,
+        created on first use.
+        """
+        if self._member_runs is None:
+            self._member_runs = []
+            for seed in self.model.seeds:
+                run_id = utils.get_child_run_id(f'seed{seed}', tags={'ensemble_seed': seed})
+                metric_logger = utils.MetricLogger(run_id=run_id, interval=self.cfg.LEARNER.METRIC_INTERVAL)
+                self._member_runs.append((run_id, metric_logger))
+        return self._member_runs
+
+    def member_checkpoint(self, i):
+        return os.path.join(self.cfg.MISC.OUTPUT_DIR, 'replicas', f'seed{self.model.seeds[i]}.pt')
+
+    def log_member_scores(self, step=None):
+        """Log the scores of every ensemble replica to its child run, and save
+        the replicas whose validation0/tss improved.
+        """
+        if self.global_rank != 0:
+            self._member_metrics = {}
+            return
+        for (key, i), metrics in sorted(self._member_metrics.items()):
+            tag = 'test' if key == 'test' else f'validation{key}'
+            scores, *_ = metrics.compute()
+            logged = {tag + '/' + k: v.item() for k, v in scores.items()}
+            logged[tag + '/loss'] = metrics.loss
+            self.member_runs[i][1].log_metrics(logged, step=step or self.global_step)
+            if key == 0 and float(scores['tss']) > self._member_best_tss.get(i, -float('inf')):
+                self._member_best_tss[i] = float(scores['tss'])
+                os.makedirs(os.path.dirname(self.member_checkpoint(i)), exist_ok=True)
+                torch.save(self.model.members[i].state_dict(), self.member_checkpoint(i))
+        self._member_metrics = {}
+
+    def close_member_runs(self, log_checkpoints=False):
+        if self._member_runs is None or self.global_rank != 0:
+            return
+        from mlflow.tracking import MlflowClient
+        client = MlflowClient()
+        for i, (run_id, metric_logger) in enumerate(self._member_runs):
+            metric_logger.close()
+            if log_checkpoints and os.path.exists(self.member_checkpoint(i)):
+                client.log_artifact(run_id, self.member_checkpoint(i), 'checkpoints')
+            client.set_terminated(run_id)
+        self._member_runs = None
+
+    def sync_artifacts(self, artifact_path, force=False):
+        """Upload the new or changed files of the log directory."""
+        if self.global_rank != 0:
+            return
+        if artifact_path not in self._syncers:
+            self._syncers[artifact_path] = utils.ArtifactSyncer(self.logger.log_dir, artifact_path)
+        self._syncers[artifact_path].sync(force=force)
+
+    def flush_logs(self):
+        self.metric_logger.flush()
+        self.logger.experiment.flush()
+
+    def mark_step(self, phase):
+        """End a phase of the training step for the throughput monitor."""
+        if self.throughput_monitor is not None and self.training:
+            self.throughput_monitor.mark(phase)
+
+    def on_before_batch_transfer(self, batch, dataloader_idx):
+        self.mark_step('data')
+        return batch
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        self.mark_step('transfer')
+        return batch
+
     def forward(self, *args, **kwargs):
         return self.model(*args, **kwargs)
 
@@ -104,21 +269,26 @@ class Learner(pl.LightningModule):
 
     def training_step(self, batch, batch_idx):
         loss = self.model.get_loss(batch)
-        self._check_nan_loss(loss)
+        self.mark_step('forward')
+        schedule = self.vis_schedule
+        if is_due(schedule['NAN_CHECK_EVERY_N_STEPS'], self.global_step):
+            self._check_nan_loss(loss)
 
         # Scalar(s)
         self.log('train/loss', loss)
-        mlflow.log_metric('train/loss', loss.item(), step=self.global_step)
-        mlflow.log_metric('train/epoch', self.trainer.current_epoch, step=self.global_step)
+        self.metric_logger.log_metrics({
+            'train/loss': loss.item(),
+            'train/epoch': self.trainer.current_epoch,
+        }, step=self.global_step)
 
-        if self.image:
+        if self.image and self.global_rank == 0:
             # Text
-            if self.global_step in [0] or batch_idx == 0:
+            if batch_idx == 0 and is_due(schedule['META_EVERY_N_EPOCHS'], self.current_epoch):
                 self.log_meta(self.model.result)
 
             # Input videos (padded)
-            if False: #self.global_step in [0] or batch_idx == 0:
-                self.log_video('train/inputs', x)
+            if is_due(schedule['VIDEO_EVERY_N_STEPS'], self.global_step):
+                self.log_video('train/inputs', self.model.result['video'])
 
             # Layer weight
             # not changing fast enough within first epoch
@@ -126,66 +296,124 @@ class Learner(pl.LightningModule):
                 self.log_layer_weights('weight', ['convs.conv1'])
 
             # Middle layer features
-            if False: #self.global_step in [0] or batch_idx == 0:
+            if is_due(schedule['ACTIVATIONS_EVERY_N_STEPS'], self.global_step):
                 self.log_layer_activations('train features', self.model.result['video'], self.cfg.LEARNER.VIS.ACTIVATIONS)
 
             # Weight histograms
-            if True: #self.global_step in [0] or batch_idx == 0:
+            if is_due(schedule['HISTOGRAM_EVERY_N_STEPS'], self.global_step):
+                model = self.model.members[0] if hasattr(self.model, 'members') else self.model # ensemble
                 for layer_name in self.cfg.LEARNER.VIS.HISTOGRAM:
                     self.logger.experiment.add_histogram("weights/{} kernel".format(layer_name),
-                        utils.get_layer(self.model, layer_name).weight, self.global_step)
+                        utils.get_layer(model, layer_name).weight, self.global_step)
 
-        self.logger.experiment.flush()
+        self.mark_step('logging')
         return {'loss': loss}
 
+    def on_train_epoch_end(self):
+        # Wall time of the epoch, including validation
+        self.metric_logger.log_metric('train/epoch_time', time.perf_counter() - self._epoch_start,
+                                      step=self.global_step)
+        self.flush_logs()
+
+    def update_eval_metrics(self, key, loss):
+        """Accumulate the loss and predictions of an evaluation step.
+
+        Nothing is returned to Lightning, so the inputs of evaluated batches
+        are not kept until the end of the epoch.
+        """
+        result = self.model.result
+        if key not in self._eval_metrics:
+            self._eval_metrics[key] = utils.StreamingMetrics()
+        self._eval_metrics[key].update(loss, result['y_true'], result['y_prob'], result['meta'])
+        for i, (member_loss, y_prob) in enumerate(zip(result.get('loss_members', []),
+                                                      result.get('y_prob_members', []))):
+            if (key, i) not in self._member_metrics:
+                self._member_metrics[(key, i)] = utils.StreamingMetrics()
+            self._member_metrics[(key, i)].update(member_loss, result['y_true'], y_prob, result['meta'])
+
+    def on_train_epoch_start(self):
+        self._epoch_start = time.perf_counter()
+        # Same shuffle of batches and streamed shards in all workers and
+        # processes. Called before the iterator of the epoch is created.
+        loader = self.trainer.train_dataloader.loaders
+        for obj in [loader.dataset, loader.sampler, loader.batch_sampler]:
+            if callable(getattr(obj, 'set_epoch', None)): # ShardedActiveRegionDataset, DistributedBatchSampler
+                obj.set_epoch(self.current_epoch)
+
+    def on_validation_epoch_start(self):
+        self._eval_metrics = {}
+        self._member_metrics = {}
+
     def validation_step(self, batch, batch_idx, dataloader_idx):
         loss = self.model.get_loss(batch)
+        self.update_eval_metrics(dataloader_idx, loss)
 
-        result = self.model.result
-        result.update({'val_loss': loss})
-        return result
+    def sync_eval_metrics(self, keys):
+        """Gather the evaluation metrics of all processes in distributed training.
+
+        Every process syncs the metrics of all `keys` in the same order, also
+        those of loaders it got no batches of, so that the collectives match.
+        """
+        num_members = len(self.model.members) if hasattr(self.model, 'members') else 0
+        for key in keys:
+            self._eval_metrics.setdefault(key, utils.StreamingMetrics()).sync()
+            for i in range(num_members):
+                self._member_metrics.setdefault((key, i), utils.StreamingMetrics()).sync()
+        # Drop loaders without batches in any process
+        self._eval_metrics = {k: m for k, m in self._eval_metrics.items() if m.num_batches > 0}
+        self._member_metrics = {k: m for k, m in self._member_metrics.items() if m.num_batches > 0}
 
     def validation_epoch_end(self, outputs):
-        for dataloader_idx, dataloader_outputs in enumerate(outputs):
+        self.sync_eval_metrics(range(len(self.trainer.val_dataloaders)))
+        results = {idx: metrics.compute() for idx, metrics in self._eval_metrics.items()}
+        # Figures of all loaders are rendered based on the scores of loader 0
+        render = 0 in results and self.should_render(float(results[0][0]['tss']))
+        if render:
+            #step = -1 if self.global_step == 0 else None # before training
+            step = None # use global_step
+            self.log_layer_weights('weight', ['convs.conv1'], step=step)
+        for dataloader_idx, (scores, cm2, y_true, y_prob) in sorted(results.items()):
             tag = f'validation{dataloader_idx}'
-            avg_val_loss = torch.stack([out['val_loss'] for out in dataloader_outputs]).mean()
-            self.log(tag + '/loss', avg_val_loss)
-            mlflow.log_metric(tag + '/loss', avg_val_loss.item(), step=self.global_step)
-
-            if True:
-                #step = -1 if self.global_step == 0 else None # before training
-                step = None # use global_step
-                self.log_layer_weights('weight', ['convs.conv1'], step=step)
-
-            y_true = torch.cat([out['y_true'] for out in dataloader_outputs])
-            y_prob = torch.cat([out['y_prob'] for out in dataloader_outputs])
-            self.trainer.datamodule.fill_prob(tag, self.global_step, y_prob.detach().cpu().numpy())
-            scores, cm2, _ = utils.get_metrics_probabilistic(y_true, y_prob, criterion=None)
+            metrics = self._eval_metrics[dataloader_idx]
+            self.log(tag + '/loss', metrics.loss)
+            self.metric_logger.log_metric(tag + '/loss', metrics.loss, step=self.global_step)
+
+            self.trainer.datamodule.fill_prob(tag, self.global_step, y_prob.numpy(),
+                                              metrics.sample_ids().numpy())
             self.log_scores(tag, scores, step=self.global_step) # pp.pprint(scores)
-            self.log_cm(tag + '/cm2', cm2, step=self.global_step)
-            self.log_eval_plots(tag, y_true, y_prob, step=self.global_step)
-            mlflow.log_artifacts(self.logger.log_dir, 'tensorboard/train_val')
+            if render:
+                self.log_cm(tag + '/cm2', cm2, step=self.global_step)
+                self.log_eval_plots(tag, y_true, y_prob, step=self.global_step)
+            self.add_rendered_images()
+            self.flush_logs()
+            self.sync_artifacts('tensorboard/train_val')
+        self._eval_metrics = {}
+        self.log_member_scores(step=self.global_step)
+
+    def on_test_epoch_start(self):
+        self._eval_metrics = {}
+        self._member_metrics = {}
 
     def test_step(self, batch, batch_idx):
         loss = self.model.get_loss(batch)
-        result = self.model.result
-        result.update({'test_loss': loss})
-        return result
+        self.update_eval_metrics('test', loss)
 
     def test_epoch_end(self, outputs):
-        avg_test_loss = torch.stack([out['test_loss'] for out in outputs]).mean()
-        self.log('test/loss', avg_test_loss)
-        y_true = torch.cat([out['y_true'] for out in outputs])
-        y_prob = torch.cat([out['y_prob'] for out in outputs])
-        self.trainer.datamodule.fill_prob('test', self.global_step, y_prob.detach().cpu().numpy())
-        scores, cm2, thresh = utils.get_metrics_probabilistic(y_true, y_prob, criterion=None)
+        self.sync_eval_metrics(['test'])
+        metrics = self._eval_metrics.pop('test')
+        self.log('test/loss', metrics.loss)
+        scores, cm2, y_true, y_prob = metrics.compute()
+        self.trainer.datamodule.fill_prob('test', self.global_step, y_prob.numpy(), metrics.sample_ids().numpy())
         #self.thresh = thresh
         logger.info(scores)
         logger.info(cm2)
         self.log_scores('test', scores)
-        self.log_cm('test/cm2', cm2)
-        self.log_eval_plots('test', y_true, y_prob)
-        mlflow.log_artifacts(self.logger.log_dir, 'tensorboard/test')
+        if self.global_rank == 0:
+            self.log_cm('test/cm2', cm2)
+            self.log_eval_plots('test', y_true, y_prob)
+        self.log_member_scores()
+        self.flush_logs()
+        self.sync_artifacts('tensorboard/test')
 
     def predict_step(self, batch, batch_idx: int , dataloader_idx: int = None):
         _ = self.model.get_loss(batch)
@@ -199,32 +427,50 @@ class Learner(pl.LightningModule):
         return torch.optim.Adam(self.parameters(), lr=self.cfg.LEARNER.LEARNING_RATE)
 
     def on_train_end(self):
-        for tag, df in self.trainer.datamodule.val_history.items():
+        self.add_rendered_images(wait=True)
+        self.flush_logs()
+        self.sync_artifacts('tensorboard/train_val', force=True) # final full sync
+        self.metric_logger.close()
+        self._metric_logger = None
+        self.close_member_runs(log_checkpoints=True)
+        if self.global_rank != 0:
+            return
+        for tag, history in self.trainer.datamodule.val_history.items():
             if tag == 'test':
                 continue # val_history['test'] does not update every epoch.
-            tmp_path = 'outputs/val_predictions.csv'
-            df.to_csv(tmp_path)
+            tmp_path = 'outputs/val_predictions.npz'
+            history.save(tmp_path)
             mlflow.log_artifact(tmp_path, tag) # tag in ['validation0', ..., 'test']
 
     def on_test_end(self):
-        tmp_path = 'outputs/test_predictions.csv'
-        self.trainer.datamodule.val_history['test'].to_csv(tmp_path)
+        self.add_rendered_images(wait=True)
+        self.flush_logs()
+        self.sync_artifacts('tensorboard/test', force=True) # final full sync
+        self.metric_logger.close()
+        self._metric_logger = None
+        self.close_member_runs()
+        if self.global_rank != 0:
+            return
+        tmp_path = 'outputs/test_predictions.npz'
+        self.trainer.datamodule.val_history['test'].save(tmp_path)
         mlflow.log_artifact(tmp_path, 'test')
 
     def log_meta(self, outputs, step=None):
         video = outputs['video']
-        meta = outputs['meta']
+        meta = outputs['meta'].detach().cpu().numpy()
         video = video.detach().cpu().numpy()
         y_true = outputs['y_true'].detach().cpu().numpy()
         y_prob = outputs['y_prob'].detach().cpu().numpy()
-        info = utils.generate_batch_info_classification(video, meta, y_true=y_true, y_prob=y_prob)
+        info = utils.generate_batch_info_classification(video, meta, y_true=y_true, y_prob=y_prob,
+                                                        df_sample=self.trainer.datamodule.df_train)
         step = step or self.global_step
         self.logger.experiment.add_text("batch info", info.to_markdown(), step)
         return info
 
     def log_video(self, tag, video, size=None, normalized=False, step=None):
         from skimage.transform import resize
-        size = np.round(size.detach().cpu().numpy() * [38, 78] + [78, 157]).astype(int)
+        if size is not None:
+            size = np.round(size.detach().cpu().numpy() * [38, 78] + [78, 157]).astype(int)
 
         # video: [N, C, T, H, W]
         if video.shape[0] > 8:
@@ -251,29 +497,25 @@ class Learner(pl.LightningModule):
             for layer_name in layer_names:
                 layer = utils.get_layer(self.model, layer_name)
                 if isinstance(layer, torch.nn.Conv3d):
+                    weight = layer.weight.detach().cpu().numpy()
                     # Unscaled
-                    fig = utils.draw_conv2d_weight(layer.weight)
-                    image_tensor = utils.fig2rgb(fig)
                     save_name = tag + f'/unscaled/{layer_name}'
-                    self.logger.experiment.add_image(save_name, image_tensor, step)
-                    save_name += f'/{step}.png'
-                    mlflow.log_figure(fig, save_name)
+                    self.renderer.submit('conv2d_weight', {'weight': weight},
+                                         save_name, step, save_name + f'/{step}.png')
 
                     # Set vmin vmax
-                    fig = utils.draw_conv2d_weight(layer.weight, vmin=-0.3, vmax=0.3) # -1/+1 for lr 1e-2
-                    image_tensor = utils.fig2rgb(fig)
                     save_name = tag + f'/uniform_scaled/{layer_name}'
-                    self.logger.experiment.add_image(save_name, image_tensor, step)
-                    save_name += f'/{step}.png'
-                    mlflow.log_figure(fig, save_name)
+                    self.renderer.submit('conv2d_weight', {'weight': weight, 'vmin': -0.3, 'vmax': 0.3}, # -1/+1 for lr 1e-2
+                                         save_name, step, save_name + f'/{step}.png')
 
     def log_layer_activations(self, tag, x, layer_names, step=None):
         step = step or self.global_step
         import copy
-        model = copy.copy(self.model) # shallow copy, the original model keeps training mode and no activation hook attached
+        model = self.model.members[0] if hasattr(self.model, 'members') else self.model # ensemble
+        model = copy.copy(model) # shallow copy, the original model keeps training mode and no activation hook attached
         activations = utils.register_activations(model, layer_names)
         model.eval()
-        _ = self.model(x)
+        _ = model(x)
         for layer_name in activations:
             features = activations[layer_name].detach().cpu()
             if features.shape[0] > 8:
@@ -291,32 +533,19 @@ class Learner(pl.LightningModule):
         for k, v in scores.items():
             #self.logger.experiment.add_scalar(tag + '/' + k, v, step)
             self.log(tag + '/' + k, v) #wield problem
-        mlflow.log_metrics({tag + '/' + k: v.item() for k, v in scores.items()},
-                           step=step)
+        self.metric_logger.log_metrics({tag + '/' + k: v.item() for k, v in scores.items()},
+                                       step=step)
 
     def log_cm(self, tag, cm, labels=None, step=None):
         step = step or self.global_step
-        fig = utils.draw_confusion_matrix(cm.cpu())
-        image_tensor = utils.fig2rgb(fig)
-        self.logger.experiment.add_image(tag, image_tensor, step)
-        mlflow.log_figure(fig, tag + f'/{step}.png')
+        self.renderer.submit('confusion_matrix', {'cm': cm.cpu().numpy()},
+                             tag, step, tag + f'/{step}.png')
 
     def log_eval_plots(self, tag, y_true, y_prob, step=None):
-        y_true = y_true.detach().cpu()
-        y_prob = y_prob.detach().cpu()
+        data = {
+            'y_true': y_true.detach().cpu().numpy(),
+            'y_prob': y_prob.detach().cpu().numpy(),
+        }
         step = step or self.global_step
-
-        reliability = utils.draw_reliability_plot(y_true, y_prob, n_bins=10)
-        mlflow.log_figure(reliability, tag + f'/reliability/{step}.png')
-        reliability = utils.fig2rgb(reliability)
-        self.logger.experiment.add_image(tag + '/reliability', reliability, step)
-
-        roc = utils.draw_roc(y_true, y_prob)
-        mlflow.log_figure(roc, tag + f'/roc/{step}.png')
-        roc = utils.fig2rgb(roc)
-        self.logger.experiment.add_image(tag + '/roc', roc, step)
-
-        ssp = utils.draw_ssp(y_true, y_prob)
-        mlflow.log_figure(ssp, tag + f'/ssp/{step}.png')
-        ssp = utils.fig2rgb(ssp)
-        self.logger.experiment.add_image(tag + '/ssp', ssp, step)
+        for kind in ['reliability', 'roc', 'ssp']:
+            self.renderer.submit(kind, data, tag + f'/{kind}', step, tag + f'/{kind}/{step}.png')
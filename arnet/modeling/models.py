@@ -75,15 +75,20 @@ class SimpleC3D(nn.Module):
         s = SETTINGS[cfg.LEARNER.MODEL.SETTINGS].copy()
 
         # Convolution layers
+        adaptive = cfg.LEARNER.MODEL.ADAPTIVE_POOL
         convs = OrderedDict()
         out_prev = input_shape[0]
         for i, (out, kern, pad, pool) in enumerate(zip(s['out_channels'], s['kernels'], s['paddings'], s['poolings'])):
             convs[f'conv{i+1}'] = nn.Conv3d(out_prev, out, kern, padding=pad)
             convs[f'conv_relu{i+1}'] = nn.LeakyReLU()
-            convs[f'conv_pool{i+1}'] = nn.MaxPool3d(pool)
+            convs[f'conv_pool{i+1}'] = nn.MaxPool3d(pool, ceil_mode=adaptive)
             #convs[f'conv_bn{i+1}'] = nn.BatchNorm3d(out)
             out_prev = out
         self.convs = nn.Sequential(convs)
+        if adaptive:
+            # Pool any H, W to the conv output shape of the nominal input
+            output_shape = self.infer_output_shape(self.convs, input_shape)
+            self.convs.add_module('adaptive_pool', nn.AdaptiveAvgPool3d(tuple(output_shape[1:])))
 
         # Linear layers
         linears = OrderedDict()
@@ -150,15 +155,20 @@ class CNN_Li2020(nn.Module):
         s = SETTINGS[cfg.LEARNER.MODEL.SETTINGS].copy()
 
         # Convolution layers
+        adaptive = cfg.LEARNER.MODEL.ADAPTIVE_POOL
         convs = OrderedDict()
         out_prev = input_shape[0]
         for i, (out, kern, pad, pool) in enumerate(zip(s['out_channels'], s['kernels'], s['paddings'], s['poolings'])):
             convs[f'conv{i + 1}'] = nn.Conv3d(out_prev, out, kern, padding=pad)
             convs[f'conv_bn{i+1}'] = nn.BatchNorm3d(out)
             convs[f'conv_relu{i + 1}'] = nn.ReLU()
-            convs[f'conv_pool{i + 1}'] = nn.MaxPool3d(pool)
+            convs[f'conv_pool{i + 1}'] = nn.MaxPool3d(pool, ceil_mode=adaptive)
             out_prev = out
         self.convs = nn.Sequential(convs)
+        if adaptive:
+            # Pool any H, W to the conv output shape of the nominal input
+            output_shape = self.infer_output_shape(self.convs, input_shape)
+            self.convs.add_module('adaptive_pool', nn.AdaptiveAvgPool3d(tuple(output_shape[1:])))
 
         # Linear layers
         linears = OrderedDict()
@@ -219,7 +229,7 @@ class MLP(nn.Module):
         self.result = {}
 
         linears = OrderedDict()
-        out_prev = len(cfg.DATA.FEATURES)
+        out_prev = cfg.LEARNER.MODEL.INPUT_SIZE or len(cfg.DATA.FEATURES)
         out_dims = [64, 32, 32, 8, 2]
         for i, out in enumerate(out_dims):
             linears[f'linear{i+1}'] = nn.Linear(out_prev, out)
@@ -267,7 +277,7 @@ class SimpleLSTM(nn.Module):
         self.result = {}
 
         self.lstm = nn.LSTM(
-            input_size=len(cfg.DATA.FEATURES),
+            input_size=cfg.LEARNER.MODEL.INPUT_SIZE or len(cfg.DATA.FEATURES),
             hidden_size=64,
             num_layers=2,
             batch_first=True,
@@ -324,15 +334,20 @@ class FusionNet(nn.Module):
         s = SETTINGS[cfg.LEARNER.MODEL.SETTINGS].copy()
 
         # Convolution layers
+        adaptive = cfg.LEARNER.MODEL.ADAPTIVE_POOL
         convs = OrderedDict()
         out_prev = input_shape[0]
         for i, (out, kern, pad, pool) in enumerate(zip(s['out_channels'], s['kernels'], s['paddings'], s['poolings'])):
             convs[f'conv{i+1}'] = nn.Conv3d(out_prev, out, kern, padding=pad)
             convs[f'conv_relu{i+1}'] = nn.LeakyReLU()
-            convs[f'conv_pool{i+1}'] = nn.MaxPool3d(pool)
+            convs[f'conv_pool{i+1}'] = nn.MaxPool3d(pool, ceil_mode=adaptive)
             #convs[f'conv_bn{i+1}'] = nn.BatchNorm3d(out)
             out_prev = out
         self.convs = nn.Sequential(convs)
+        if adaptive:
+            # Pool any H, W to the conv output shape of the nominal input
+            output_shape = self.infer_output_shape(self.convs, input_shape)
+            self.convs.add_module('adaptive_pool', nn.AdaptiveAvgPool3d(tuple(output_shape[1:])))
 
         # Linear layers
         linears = OrderedDict()
@@ -396,7 +411,96 @@ class FusionNet(nn.Module):
         return loss
 
 
+class _LossModule(nn.Module):
+    """Call `get_loss` of a model through `forward`, for `functional_call`."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, batch):
+        loss = self.model.get_loss(batch)
+        return loss, self.model.result['y_prob']
+
+
+class ModelEnsemble(nn.Module):
+    """Replicas of `cfg.LEARNER.MODEL` with different initialization seeds,
+    trained together on the same batches.
+
+    The loss is the sum of the replica losses, so each replica gets the
+    gradients of its own loss. Replicas are evaluated in a loop. With
+    `torch.func`, which needs torch>=2.0 and not the pinned torch 1.10, they
+    are instead evaluated in one vectorized call over their stacked
+    parameters, unless they have recurrent or batch normalization layers,
+    which `vmap` does not support. Predictions are the mean replica
+    probabilities; replica probabilities and losses are in
+    `result['y_prob_members']` and `result['loss_members']`.
+    """
+    def __init__(self, cfg):
+        super().__init__()
+        ens = cfg.LEARNER.ENSEMBLE
+        self.seeds = list(ens.SEEDS) or [(cfg.DATA.SEED or 0) + i for i in range(ens.SIZE)]
+        members = []
+        # Seed the replicas without changing the global RNG state, e.g., of data shuffling
+        with torch.random.fork_rng(devices=[]):
+            for seed in self.seeds:
+                torch.manual_seed(seed)
+                members.append(MODEL_REGISTRY.get(cfg.LEARNER.MODEL.NAME)(cfg))
+        self.members = nn.ModuleList(members)
+        self.result = {}
+        self.vectorize = (ens.VECTORIZE and hasattr(torch, 'func') and
+                          not any(isinstance(m, (nn.RNNBase, nn.modules.batchnorm._BatchNorm))
+                                  for m in members[0].modules()))
+        if self.vectorize:
+            import copy
+            # Not a submodule: holds no state, only the structure of a replica
+            self.__dict__['_template'] = _LossModule(copy.deepcopy(members[0]).to('meta'))
+
+    def forward(self, *args):
+        """Log of the mean replica probabilities, as logits whose softmax is
+        the ensemble prediction.
+        """
+        probs = torch.stack([F.softmax(member(*args), dim=-1) for member in self.members])
+        return torch.log(probs.mean(dim=0))
+
+    def stacked_state(self):
+        """Parameters and buffers of the replicas, stacked along a new first
+        dimension (differentiable w.r.t. the replica parameters).
+        """
+        states = []
+        for named in ['named_parameters', 'named_buffers']:
+            tensors = [dict(getattr(m, named)()) for m in self.members]
+            states.append({'model.' + k: torch.stack([t[k] for t in tensors]) for k in tensors[0]})
+        return states
+
+    def get_loss(self, batch):
+        if self.vectorize:
+            def get_loss(params, buffers, batch):
+                return torch.func.functional_call(self._template, (params, buffers), (batch,))
+
+            params, buffers = self.stacked_state()
+            losses, y_probs = torch.func.vmap(get_loss, in_dims=(0, 0, None), randomness='different')(
+                params, buffers, batch)
+            template = self._template.model
+            result = {k: v for k, v in template.result.items() if k != 'y_prob'} # inputs, labels
+            template.result = {}
+        else:
+            losses, y_probs = [], []
+            for member in self.members:
+                losses.append(member.get_loss(batch))
+                y_probs.append(member.result['y_prob'])
+            losses, y_probs = torch.stack(losses), torch.stack(y_probs)
+            result = {k: v for k, v in self.members[0].result.items() if k != 'y_prob'}
+
+        self.result = result
+        self.result['y_prob'] = y_probs.mean(dim=0)
+        self.result['y_prob_members'] = y_probs # [N, B]
+        self.result['loss_members'] = losses.detach()
+        return losses.sum()
+
+
 def build_model(cfg):
+    if cfg.LEARNER.ENSEMBLE.SIZE > 1 or cfg.LEARNER.ENSEMBLE.SEEDS:
+        return ModelEnsemble(cfg)
     name = cfg.LEARNER.MODEL.NAME
     model = MODEL_REGISTRY.get(name)(cfg)
     return model
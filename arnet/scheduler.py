@@ -0,0 +1,224 @@
+"""Run a grid of training jobs in parallel processes within resource limits.
+
+Every job is one `run_arnet.py` process that logs a nested MLflow run of the
+sweep run. Jobs take CPU cores, memory, and optionally a GPU from the
+available slots, and torch in each job is limited to its cores. A job is
+identified by its `sweep_job` tag, so jobs that already finished in the
+experiment are skipped when a sweep is restarted.
+"""
+import os
+import sys
+import time
+import logging
+import itertools
+import subprocess
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_job_key(tags):
+    """Identifier of a job from its tags, logged as the `sweep_job` tag."""
+    return '|'.join(f'{k}={tags[k]}' for k in sorted(tags))
+
+
+def expand_grid(databases, datasets, configs, seeds, test_splits=(None,), val_splits=(None,),
+                balanced=(True,), opts=()):
+    """List the jobs of all combinations of the arguments.
+
+    Returns:
+        jobs: List of dicts with keys 'config', 'opts', 'run_name', 'tags'.
+    """
+    jobs = []
+    grid = itertools.product(databases, balanced, datasets, configs, seeds, test_splits, val_splits)
+    for database, bal, dataset, config, seed, test_split, val_split in grid:
+        database, config = Path(database), Path(config)
+        tags = {
+            'database_name': database.name,
+            'balanced': bal,
+            'estimator_name': config.stem,
+            'dataset_name': dataset,
+            'seed': seed,
+            'test_split': test_split,
+            'val_split': val_split,
+            'opts': ' '.join(map(str, opts)),
+        }
+        jobs.append({
+            'config': str(config),
+            'opts': list(opts) + [
+                'DATA.DATABASE', database,
+                'DATA.DATASET', dataset,
+                'DATA.BALANCED', bal,
+                'DATA.SEED', seed, # used in data rus and training
+                'DATA.TEST_SPLIT', test_split,
+                'DATA.VAL_SPLIT', val_split,
+            ],
+            'run_name': '_'.join([database.name, config.stem, dataset]),
+            'tags': tags,
+        })
+    return jobs
+
+
+def get_completed_jobs(experiment_name):
+    """Keys of the jobs that finished in the experiment."""
+    from mlflow.tracking import MlflowClient
+    client = MlflowClient()
+    experiment = client.get_experiment_by_name(experiment_name)
+    if experiment is None:
+        return set()
+    runs = client.search_runs([experiment.experiment_id],
+                              filter_string="attributes.status = 'FINISHED'",
+                              max_results=50000)
+    return {run.data.tags['sweep_job'] for run in runs if 'sweep_job' in run.data.tags}
+
+
+def get_total_memory():
+    """Physical memory in GB."""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+
+
+class SweepScheduler():
+    """Run jobs as `run_arnet.py` processes, as many at once as the slots allow.
+
+    Args:
+        jobs: Jobs of `expand_grid`.
+        experiment_name: MLflow experiment of the sweep.
+        parent_run_id: Sweep run that job runs are nested in.
+        max_cpus: CPU cores for all jobs. Defaults to all cores.
+        cpus_per_job: CPU cores (and torch threads) per job.
+        max_memory: Memory for all jobs in GB. Defaults to physical memory.
+        memory_per_job: Memory per job in GB.
+        gpus: Number of GPUs. If positive, each job takes one GPU.
+        max_jobs: Additional limit on the number of concurrent jobs.
+        log_dir: Directory of the stdout and stderr of every job.
+    """
+    def __init__(self, jobs, experiment_name, parent_run_id, max_cpus=None, cpus_per_job=4,
+                 max_memory=None, memory_per_job=8, gpus=0, max_jobs=None,
+                 log_dir='outputs/sweep'):
+        self.jobs = jobs
+        self.experiment_name = experiment_name
+        self.parent_run_id = parent_run_id
+        self.cpus_per_job = cpus_per_job
+        slots = [
+            max(1, (max_cpus or os.cpu_count() or 1) // cpus_per_job),
+            max(1, int((max_memory or get_total_memory()) // memory_per_job)),
+        ]
+        if gpus > 0:
+            slots.append(gpus)
+        if max_jobs:
+            slots.append(max_jobs)
+        self.num_slots = min(slots)
+        self.free_gpus = list(range(gpus))
+        self.log_dir = Path(log_dir)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_command(self, job):
+        cmd = [sys.executable, str(Path(__file__).parents[1] / 'run_arnet.py'),
+               '--experiment_name', self.experiment_name,
+               '--run_name', job['run_name'],
+               '--config', job['config'],
+               '--modes', 'train|test',
+               '--parent_run_id', self.parent_run_id]
+        tags = dict(job['tags'], sweep_job=get_job_key(job['tags']))
+        for k, v in tags.items():
+            cmd += ['--tag', f'{k}={v}']
+        # Loader workers within the cores of the job, as torch threads
+        opts = list(job['opts']) + ['DATA.NUM_WORKERS', min(self.get_num_workers(job), self.cpus_per_job)]
+        return cmd + [str(o) for o in opts]
+
+    @staticmethod
+    def get_num_workers(job):
+        """DATA.NUM_WORKERS of the config and opts of `job`."""
+        from arnet.config import cfg
+        cfg = cfg.clone()
+        cfg.merge_from_file(job['config'])
+        cfg.merge_from_list([str(o) for o in job['opts']])
+        return cfg.DATA.NUM_WORKERS
+
+    def start(self, job, i):
+        env = dict(os.environ)
+        for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS']: # torch threads
+            env[var] = str(self.cpus_per_job)
+        gpu = None
+        if self.free_gpus:
+            gpu = self.free_gpus.pop(0)
+            env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+        log_file = open(self.log_dir / f'{i:04d}_{job["run_name"]}.log', 'w')
+        proc = subprocess.Popen(self.get_command(job), env=env, stdout=log_file,
+                                stderr=subprocess.STDOUT)
+        return {'job': job, 'index': i, 'proc': proc, 'gpu': gpu, 'log_file': log_file,
+                't_start': time.time()}
+
+    def run(self, completed=(), poll=5.0, report_every=60.0):
+        """Run the jobs whose keys are not in `completed`.
+
+        Returns:
+            failed: List of the failed jobs.
+        """
+        pending = [(i, job) for i, job in enumerate(self.jobs)
+                   if get_job_key(job['tags']) not in completed]
+        self.stats = {'skipped': len(self.jobs) - len(pending), 'done': 0, 'failed': 0}
+        self.durations = []
+        running, failed = [], []
+        self.t_start = time.time()
+        t_report = 0
+        logger.info('%d jobs, %d already completed, %d slots',
+                    len(self.jobs), self.stats['skipped'], self.num_slots)
+        try:
+            while pending or running:
+                changed = False
+                while pending and len(running) < self.num_slots:
+                    i, job = pending.pop(0)
+                    running.append(self.start(job, i))
+                    changed = True
+                time.sleep(poll)
+                for task in list(running):
+                    returncode = task['proc'].poll()
+                    if returncode is None:
+                        continue
+                    running.remove(task)
+                    task['log_file'].close()
+                    if task['gpu'] is not None:
+                        self.free_gpus.append(task['gpu'])
+                    if returncode == 0:
+                        self.stats['done'] += 1
+                        self.durations.append(time.time() - task['t_start'])
+                    else:
+                        self.stats['failed'] += 1
+                        failed.append(task['job'])
+                        logger.warning('Job %d %s failed (exit code %d), see %s', task['index'],
+                                       task['job']['run_name'], returncode, task['log_file'].name)
+                    changed = True
+                if changed or time.time() - t_report > report_every:
+                    logger.info('Sweep progress:\n' + self.progress(pending, running))
+                    t_report = time.time()
+        except KeyboardInterrupt:
+            for task in running:
+                task['proc'].terminate()
+            raise
+        return failed
+
+    def progress(self, pending, running):
+        """Table of the job counts, ETA, and running jobs."""
+        import pandas as pd
+        elapsed = time.time() - self.t_start
+        eta = float('nan')
+        if self.durations:
+            mean_duration = sum(self.durations) / len(self.durations)
+            eta = mean_duration * (len(pending) + len(running) / 2) / self.num_slots
+        summary = pd.DataFrame([{
+            **self.stats,
+            'running': len(running),
+            'pending': len(pending),
+            'elapsed_min': round(elapsed / 60, 1),
+            'eta_min': round(eta / 60, 1),
+        }])
+        rows = [{'job': task['index'], 'run_name': task['job']['run_name'],
+                 'seed': task['job']['tags']['seed'], 'gpu': task['gpu'],
+                 'running_min': round((time.time() - task['t_start']) / 60, 1)}
+                for task in running]
+        table = summary.to_markdown(index=False)
+        if rows:
+            table += '\n\n' + pd.DataFrame(rows).to_markdown(index=False)
+        return table
@@ -0,0 +1,70 @@
+"""Temporal features of the keyword sequence of every sample window.
+
+Keyword windows of all samples are loaded at once with
+`load_parameter_windows` (one header read per active region) and reduced
+with vectorized numpy along the time axis. Features are written to
+`{database}/{dataset}_sequence_features.csv`, one row per sample of
+`{database}/{dataset}.csv`, and merged by `arnet.fusion.load_database`.
+
+Example:
+    python -m arnet.sequence_features datasets/M_Q_24hr
+"""
+import argparse
+from pathlib import Path
+import numpy as np
+
+
+FEATURE_FILE = '{dataset}_sequence_features.csv'
+KEYWORDS = ['AREA', 'USFLUXL', 'MEANGBL', 'R_VALUE']
+LAGS = [1, 4] # frames
+STATS = ['SLOPE', 'MAX', 'STD'] + [f'LAG{k}' for k in LAGS]
+SEQUENCE_FEATURES = [f'{k}_{s}' for k in KEYWORDS for s in STATS]
+KEYS = ['prefix', 'arpnum', 't_end'] # align features with samples
+
+
+def window_stats(windows):
+    """Statistics along the time axis.
+
+    Args:
+        windows: Array of shape [N, T, F].
+
+    Returns:
+        stats: Array of shape [N, F, len(STATS)]. Slopes are per frame
+            (least squares), lags are differences from the last frame.
+    """
+    T = windows.shape[1]
+    t = np.arange(T) - (T - 1) / 2
+    slope = np.einsum('t,ntf->nf', t, windows - windows.mean(axis=1, keepdims=True)) / (t ** 2).sum()
+    stats = [slope, windows.max(axis=1), windows.std(axis=1)]
+    stats += [windows[:, -1] - windows[:, -1 - k] for k in LAGS]
+    return np.stack(stats, axis=-1)
+
+
+def extract_sequence_features(df, num_frames=16):
+    """Sequence features of all samples of a processed dataset, in the order of `df`."""
+    from arnet.dataset import load_parameter_windows
+    windows = load_parameter_windows(df, KEYWORDS, num_frames=num_frames)
+    stats = window_stats(windows).reshape(len(df), -1) # keyword-major, as SEQUENCE_FEATURES
+    df_features = df[KEYS].reset_index(drop=True).copy()
+    df_features[SEQUENCE_FEATURES] = stats
+    return df_features
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keyword sequence features of the samples of processed datasets')
+    parser.add_argument('database', help='Directory with smarp.csv and sharp.csv')
+    parser.add_argument('--datasets', nargs='+', default=['sharp', 'smarp'])
+    parser.add_argument('--num_frames', type=int, default=16)
+    args = parser.parse_args()
+
+    from arnet.fusion import load_csv_dataset
+    for dataset in args.datasets:
+        df = load_csv_dataset(Path(args.database) / f'{dataset}.csv')
+        df_features = extract_sequence_features(df, num_frames=args.num_frames)
+        path = Path(args.database) / FEATURE_FILE.format(dataset=dataset)
+        df_features.to_csv(path, index=False)
+        print(f'{path}: {len(df_features)} samples, {len(SEQUENCE_FEATURES)} features')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ import torch
 import torch.nn.functional as F
 from fvcore.common.registry import Registry
 
-from arnet.constants import CONSTANTS # run in the flare-
+from arnet.constants import get_feature_stats # run in the flare-
 
 
 TRANSFORM_REGISTRY = Registry("TRANSFORM")
@@ -79,6 +79,45 @@ class Resize():
         return resized_video
 
 
+@TRANSFORM_REGISTRY.register()
+class FrameResize():
+    """Resize a video of C x T x H x W frame by frame.
+
+    Frames are treated as a batch of 2D images, so the time axis is never
+    interpolated. `area` mode averages over the source pixels covered by each
+    target pixel, which avoids the aliasing of `Resize` when downsampling.
+
+    Args:
+        target_size: (H, W)
+        mode: Interpolation mode of `F.interpolate`. One of 'area',
+            'bilinear', 'bicubic' or 'nearest'.
+        antialias: Apply an antialiasing filter when downsampling. Only valid
+            for 'bilinear' and 'bicubic' modes (requires torch>=1.11).
+    """
+    def __init__(self, target_size, mode='area', antialias=False):
+        import inspect
+        if antialias:
+            if mode not in ['bilinear', 'bicubic']:
+                raise ValueError(f"FrameResize antialias requires mode 'bilinear' or 'bicubic', got '{mode}'")
+            if 'antialias' not in inspect.signature(F.interpolate).parameters:
+                raise ValueError(f'FrameResize antialias requires torch>=1.11, found {torch.__version__}. '
+                                 "Set DATA.RESIZE_ANTIALIAS False or use DATA.RESIZE_MODE 'area'")
+        self.target_size = tuple(target_size)
+        self.mode = mode
+        self.antialias = antialias
+
+    def __call__(self, video):
+        kwargs = {}
+        if self.mode in ['bilinear', 'bicubic']:
+            kwargs['align_corners'] = False
+            if self.antialias:
+                kwargs['antialias'] = True
+        frames = video.transpose(0, 1) # T,C,H,W
+        frames = F.interpolate(frames, size=self.target_size, mode=self.mode, **kwargs)
+        resized_video = frames.transpose(0, 1) # C,T,H,W
+        return resized_video
+
+
 @TRANSFORM_REGISTRY.register()
 class ValueTransform():
     def __init__(self, shrinkage='1/2', thresh=236):
@@ -130,6 +169,10 @@ class Reverse():
 
 
 def calc_stats(hist, bins, func=None):
+    """Mean and std of a pixel histogram, optionally of `func` of the bin
+    centers. Standardize reads arnet.image_stats instead; this is kept for
+    the histograms (`hist`, `bins`) in notebooks and image_stats files.
+    """
     import numpy as np
     mids = 0.5 * (bins[1:] + bins[:-1])
     if func is not None:
@@ -147,17 +190,24 @@ def get_transform_kwargs(name, cfg):
         kwargs = {'target_size': (None, cfg.DATA.HEIGHT, cfg.DATA.WIDTH)}
     elif name == 'Resize':
         kwargs = {'target_size': (cfg.DATA.HEIGHT, cfg.DATA.WIDTH)}
+    elif name == 'FrameResize':
+        kwargs = {'target_size': (cfg.DATA.HEIGHT, cfg.DATA.WIDTH),
+                  'mode': cfg.DATA.RESIZE_MODE,
+                  'antialias': cfg.DATA.RESIZE_ANTIALIAS}
     elif name == 'Standardize':
         if 'MAGNETOGRAM' in cfg.DATA.FEATURES:
-            hist = np.load('/home/zeyusun/work/flare-prediction-smarp/datasets/sharp_hist.npy', allow_pickle=True).item() # TODO: config
-            func = get_transform('ValueTransform', cfg) if 'ValueTransform' in cfg.DATA.TRANSFORMS else None
-            mean, std = calc_stats(hist['hist'], hist['bins'], func=func)
+            # Computed by python -m arnet.image_stats
+            from arnet.image_stats import load_image_stats, get_stats_key
+            key = (get_stats_key(cfg.DATA.SHRINKAGE, cfg.DATA.THRESH)
+                   if 'ValueTransform' in cfg.DATA.TRANSFORMS else get_stats_key())
+            mean, std = load_image_stats(cfg.DATA.DATABASE, cfg.DATA.DATASET, key=key)
             cfg.DATA.IMAGE_MEAN, cfg.DATA.IMAGE_STD = float(mean), float(std)
             kwargs = {'mean': mean, 'std': std}
         else:
+            mean, std = get_feature_stats('SMARP', cfg.DATA.FEATURES, cfg.DATA.DATABASE)
             kwargs = {
-                'mean': {k: CONSTANTS['SMARP_MEAN'][k] for k in cfg.DATA.FEATURES},
-                'std': {k: CONSTANTS['SMARP_STD'][k] for k in cfg.DATA.FEATURES},
+                'mean': dict(zip(cfg.DATA.FEATURES, mean)),
+                'std': dict(zip(cfg.DATA.FEATURES, std)),
             }
     elif name == 'ValueTransform':
         kwargs = {'shrinkage': cfg.DATA.SHRINKAGE, 'thresh': cfg.DATA.THRESH}
@@ -166,6 +216,23 @@ def get_transform_kwargs(name, cfg):
     return kwargs
 
 
+# cfg.DATA fields that determine the output of the transforms
+TRANSFORM_CFG_KEYS = [
+    'TRANSFORMS', 'BUCKETING', 'HEIGHT', 'WIDTH', 'RESIZE_MODE', 'RESIZE_ANTIALIAS',
+    'SHRINKAGE', 'THRESH', 'IMAGE_MEAN', 'IMAGE_STD',
+]
+
+
+def get_transform_hash(cfg):
+    """Short hash of the transform config. Used to key cached samples."""
+    import json
+    import hashlib
+
+    d = {k: cfg.DATA[k] for k in TRANSFORM_CFG_KEYS}
+    s = json.dumps(d, sort_keys=True, default=float)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()[:16]
+
+
 def get_transform(name, cfg):
     kwargs = get_transform_kwargs(name, cfg)
     transform = TRANSFORM_REGISTRY.get(name)(**kwargs)
@@ -188,6 +255,31 @@ def test_ValueTransform():
     plt.show()
 
 
+def benchmark_resize(num_videos=200, size=(78, 157), target_size=(64, 128), num_frames=16):
+    """Compare throughput of `Resize` and `FrameResize` on random videos.
+
+    The effect on TSS is measured by `run_arnet.py --modes bench_resize`.
+
+    Returns:
+        stats: Dict of videos per second by transform.
+    """
+    import time
+
+    videos = [torch.randn(1, num_frames, *size) * 200 for _ in range(num_videos)]
+    transforms = {
+        'Resize': Resize(target_size),
+        'FrameResize (area)': FrameResize(target_size, mode='area'),
+        'FrameResize (bilinear)': FrameResize(target_size, mode='bilinear'),
+    }
+    stats = {}
+    for name, transform in transforms.items():
+        t_start = time.time()
+        for video in videos:
+            _ = transform(video)
+        stats[name] = num_videos / (time.time() - t_start)
+    return stats
+
+
 if __name__ == '__main__':
     # size = (3,3)
     # ccp = CenterCropPad(size)
@@ -200,3 +292,5 @@ if __name__ == '__main__':
     #         output_size = ccp(X, crop=False)
 
     test_ValueTransform()
+    for name, videos_per_sec in benchmark_resize().items():
+        print(f'{name:<24} {videos_per_sec:8.1f} videos/s')
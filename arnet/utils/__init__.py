@@ -1,10 +1,45 @@
-from .cfgnode import *
-from .data import *
-from .debug import *
-from .gradcam import *
-from .logger import *
-from .metrics import *
-from .misc import *
-from .network import *
-from .profiler import *
-from .visualization import *
+"""Utilities. Submodules are imported on first access of one of their names,
+so that importing arnet does not pull in redis, astropy, or matplotlib.
+"""
+import importlib
+
+_SUBMODULES = {
+    'callbacks': ['get_step_timer', 'ThroughputMonitor'],
+    'cfgnode': ['CfgNode'],
+    'data': ['DATA_DIR', 'REDIS_HEADER_DB', 'REDIS_IMAGE_DB', 'get_redis', 'read_header',
+             'toRedis', 'fromRedis', 'fits_open', 'query_images', 'query_parameters'],
+    'debug': ['plot', 'imshow', 'check'],
+    'gradcam': ['revert_tensor_normalize', 'GradCAM'],
+    'logger': ['ColoredFormatter', 'setup_logger'],
+    'metrics': ['accuracy', 'true_skill_statistic', 'heidke_skill_score', 'confusion_matrix',
+                'get_thresh', 'get_scores_from_cm', 'get_metrics_probabilistic',
+                'get_scores_from_prob', 'StreamingMetrics', 'PredictionHistory',
+                'get_metrics_multiclass'],
+    'misc': ['file_scanning', 'array_to_uint8', 'array_to_float_video',
+             'generate_batch_info_classification', 'generate_batch_info_regression'],
+    'network': ['get_layer', 'register_single_activation', 'register_activations'],
+    'profiler': ['Profiler', 'benchmark_dataloader', 'import_time'],
+    'rendering': ['render_figure', 'FigureRenderer'],
+    'tracking': ['MetricLogger', 'ArtifactSyncer', 'get_child_run_id', 'benchmark_metric_logging'],
+    'visualization': ['get_log_intensity', 'get_flare_class', 'plot_flare_history', 'fig2rgb',
+                      'draw_conv2d_weight', 'draw_confusion_matrix', 'calibration_curve',
+                      'squarify', 'check_and_convert', 'draw_reliability_plot', 'draw_roc',
+                      'draw_tpr_fpr', 'draw_ssp', 'plot_prediction_curve'],
+}
+_ATTRS = {name: module for module, names in _SUBMODULES.items() for name in names}
+
+__all__ = list(_ATTRS)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    if name not in _ATTRS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_ATTRS[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_SUBMODULES) + __all__)
@@ -0,0 +1,145 @@
+"""Lightning callbacks that time training steps.
+
+Kept apart from `arnet.utils.profiler`, so that profiling helpers do not
+import pytorch_lightning.
+"""
+import time
+import logging
+from collections import deque
+
+import numpy as np
+import pytorch_lightning as pl
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_step_timer(skip=5):
+    """A Lightning callback that measures training steps per second.
+
+    The first `skip` steps (warm-up, e.g., cudnn autotuning) are not timed.
+    The rate is available as `steps_per_sec` after training.
+    """
+    class StepTimer(pl.Callback):
+        def __init__(self):
+            self.num_steps = 0
+            self.t_start = None
+            self.steps_per_sec = float('nan')
+
+        def on_train_batch_end(self, trainer, pl_module, *args, **kwargs):
+            self.num_steps += 1
+            if self.num_steps == skip:
+                self.t_start = time.time()
+            elif self.num_steps > skip:
+                self.steps_per_sec = (self.num_steps - skip) / (time.time() - self.t_start)
+
+    return StepTimer()
+
+
+class ThroughputMonitor(pl.Callback):
+    """Break the training step time down into phases and report throughput.
+
+    Phases are timed on the host between marks: 'data' (blocked on the
+    DataLoader), 'transfer' (host to device), 'forward' and 'logging' (marked
+    by the learner in `training_step`), 'backward', and 'optimizer' (step
+    and zero_grad). Time before a missing mark counts to the next phase.
+    Every `log_every_n_steps`, rolling samples/sec, mean phase times and
+    step time percentiles over the last `window` steps are logged to MLflow
+    and TensorBoard, and training is flagged input-bound when the data and
+    transfer phases take more than `input_bound_ratio` of the step time.
+
+    Args:
+        sync_cuda: Synchronize CUDA at marks, so that device time is charged
+            to its phase instead of the next blocking call. Slows training.
+    """
+    PHASES = ['data', 'transfer', 'forward', 'logging', 'backward', 'optimizer']
+    INPUT_PHASES = ['data', 'transfer']
+
+    def __init__(self, window=100, log_every_n_steps=50, input_bound_ratio=0.3, sync_cuda=False):
+        self.window = window
+        self.log_every_n_steps = log_every_n_steps
+        self.input_bound_ratio = input_bound_ratio
+        self.sync_cuda = sync_cuda
+        self.history = deque(maxlen=window) # (num_samples, {phase: seconds})
+        self.input_bound = False
+        self._t = None
+        self._step = {}
+
+    def mark(self, phase):
+        """End `phase` of the current training step."""
+        if self._t is None:
+            return
+        if self.sync_cuda:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        t = time.perf_counter()
+        self._step[phase] = self._step.get(phase, 0.0) + t - self._t
+        self._t = t
+
+    def on_train_start(self, trainer, pl_module):
+        pl_module.throughput_monitor = self
+
+    def on_train_end(self, trainer, pl_module):
+        pl_module.throughput_monitor = None
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._t = time.perf_counter() # waiting for the first batch
+        self._step = {}
+
+    def on_after_backward(self, trainer, pl_module):
+        self.mark('backward')
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        self.mark('optimizer')
+        self.history.append((len(batch[-1]), self._step)) # label or sample ids
+        self._step = {}
+        if trainer.global_step % self.log_every_n_steps == 0:
+            self.log_stats(trainer, pl_module, self.summary())
+
+    def on_validation_start(self, trainer, pl_module):
+        self._t = None # do not time validation
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.training:
+            self._t = time.perf_counter() # validation within the epoch
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        self._t = None
+
+    def summary(self):
+        """Rolling throughput statistics of the last `window` steps."""
+        num_samples = sum(n for n, _ in self.history)
+        times = np.array([[step.get(p, 0.0) for p in self.PHASES] for _, step in self.history])
+        step_times = times.sum(axis=1)
+        input_fraction = times[:, :len(self.INPUT_PHASES)].sum() / step_times.sum()
+        stats = {'samples_per_sec': num_samples / step_times.sum()}
+        stats.update({f'{p}_ms': t * 1e3 for p, t in zip(self.PHASES, times.mean(axis=0))})
+        stats.update({f'step_ms_p{q}': np.percentile(step_times, q) * 1e3 for q in [50, 90, 99]})
+        stats.update({
+            'input_fraction': input_fraction,
+            'input_bound': float(input_fraction > self.input_bound_ratio),
+        })
+        return stats
+
+    def log_stats(self, trainer, pl_module, stats):
+        if not trainer.is_global_zero:
+            return
+        metrics = {f'throughput/{k}': v for k, v in stats.items()}
+        step = trainer.global_step
+        metric_logger = getattr(pl_module, 'metric_logger', None)
+        if metric_logger is not None:
+            metric_logger.log_metrics(metrics, step=step)
+        else:
+            import mlflow
+            mlflow.log_metrics(metrics, step=step)
+        if trainer.logger is not None:
+            for k, v in metrics.items():
+                trainer.logger.experiment.add_scalar(k, v, step)
+
+        input_bound = bool(stats['input_bound'])
+        if input_bound and not self.input_bound:
+            logger.warning('Training is input-bound: %.0f%% of the step time is spent waiting for '
+                           'data (%.1f samples/s). Consider more DATA.NUM_WORKERS or DATA.CACHE_DIR.',
+                           stats['input_fraction'] * 100, stats['samples_per_sec'])
+        self.input_bound = input_bound
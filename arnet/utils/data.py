@@ -1,15 +1,21 @@
 import os
 import json
 import logging
+from functools import lru_cache
 import numpy as np
 import pandas as pd
-import redis
-from astropy.io import fits
 
 
 DATA_DIR = '/data2'
-r_header = redis.Redis(db=3)
-r_image = redis.Redis(db=13)
+REDIS_HEADER_DB = 3
+REDIS_IMAGE_DB = 13
+
+
+@lru_cache(maxsize=None)
+def get_redis(db):
+    """Redis client of a database, created on first use."""
+    import redis
+    return redis.Redis(db=db)
 
 
 def read_header(dataset, arpnum, index_col=None):
@@ -58,6 +64,7 @@ def fits_open(filepath):
     SHARP   0.03 deg            0 deg
     SMARP   0.12 deg            0 deg
     """
+    from astropy.io import fits
     data = fits.open(filepath)[1].data
     if 'sharp' in filepath:
         data = data[::4, ::4]
@@ -74,6 +81,7 @@ def query_images(filepaths, redis=True):
         filepaths = [filepaths]
 
     if redis:
+        r_image = get_redis(REDIS_IMAGE_DB)
         buff = r_image.mget(filepaths)
         indices = [i for i, b in enumerate(buff) if b is None]
         if len(indices) > 0:
@@ -109,6 +117,7 @@ def query_parameters(prefix, arpnum, t_recs, keywords, redis=True):
     KEYWORDS = ['T_REC', 'AREA', 'USFLUXL', 'MEANGBL', 'R_VALUE']
 
     if redis:
+        r_header = get_redis(REDIS_HEADER_DB)
         id = f'{prefix}{arpnum:06d}' # header file identifier
         if r_header.exists(id) == 0:
             dataset = 'sharp' if prefix == 'HARP' else 'smarp'
@@ -136,7 +136,6 @@ def get_metrics_probabilistic(y_true, y_prob, criterion='tss'):
     =====================================================
     """
     import torch
-    from torchmetrics.functional import auroc
     #from sklearn.metrics import roc_auc_score
     if not isinstance(y_true, torch.Tensor):
         y_true = torch.tensor(y_true)
@@ -147,19 +146,189 @@ def get_metrics_probabilistic(y_true, y_prob, criterion='tss'):
     y_pred = y_prob > thresh
     cm = confusion_matrix(y_pred, y_true, num_classes=2)
     scores = get_scores_from_cm(cm)
+    scores.update(get_scores_from_prob(y_true, y_prob))
+
+    return scores, cm, thresh
+
 
+def get_scores_from_prob(y_true, y_prob):
+    """Threshold-free scores (AUC and BSS) of probabilistic predictions."""
+    from torchmetrics.functional import auroc
     y_clim = torch.mean(y_true.double())
     bss = 1 - torch.mean((y_prob - y_true)**2) / torch.mean((y_prob - y_clim)**2)
     try:
         auc = auroc(y_prob, y_true)
     except ValueError: # Only one class present in y_true. ROC AUC score is not defined in that case.
         auc = torch.tensor(float('NaN'))
-    scores.update({
+    return {
         'auc': auc,
         'bss': bss,
-    })
+    }
 
-    return scores, cm, thresh
+
+class StreamingMetrics():
+    """Accumulate the loss and predictions of an evaluation epoch step by step.
+
+    Only the loss sum, the confusion matrix at threshold 0.5, and the labels,
+    probabilities and sample indices (on CPU) are kept, so memory does not
+    grow with the inputs of the evaluated batches. In distributed training,
+    `sync` gathers the states of all processes before `compute`.
+    """
+    def __init__(self):
+        self.loss_sum = 0.0
+        self.num_batches = 0
+        self.cm = torch.zeros(2, 2)
+        self.y_true, self.y_prob, self.idx = [], [], []
+
+    def update(self, loss, y_true, y_prob, idx):
+        y_true, y_prob, idx = (t.detach().cpu() for t in (y_true, y_prob, idx))
+        self.loss_sum += float(loss)
+        self.num_batches += 1
+        self.cm += confusion_matrix(y_prob > 0.5, y_true, num_classes=2)
+        self.y_true.append(y_true)
+        self.y_prob.append(y_prob)
+        self.idx.append(idx)
+
+    def sync(self):
+        """Merge the states of all processes of distributed training.
+
+        Samples evaluated by more than one process (e.g., padding of
+        `DistributedSampler`) are counted once, by sample index.
+        """
+        import torch.distributed as dist
+        if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+            return
+        states = [None] * dist.get_world_size()
+        dist.all_gather_object(states, (self.loss_sum, self.num_batches,
+                                        self.y_true, self.y_prob, self.idx))
+        self.loss_sum = sum(state[0] for state in states)
+        self.num_batches = sum(state[1] for state in states)
+        if self.num_batches == 0:
+            return
+        y_true, y_prob, idx = (torch.cat([t for state in states for t in state[i]])
+                               for i in range(2, 5))
+        _, first = np.unique(idx.numpy(), return_index=True)
+        first = torch.from_numpy(first)
+        self.y_true, self.y_prob, self.idx = [y_true[first]], [y_prob[first]], [idx[first]]
+        self.cm = confusion_matrix(self.y_prob[0] > 0.5, self.y_true[0], num_classes=2)
+
+    @property
+    def loss(self):
+        return self.loss_sum / max(self.num_batches, 1)
+
+    def predictions(self):
+        """Labels and probabilities in the sample order.
+
+        Batches may not follow the sample order, e.g., with size bucketing.
+        """
+        order = torch.argsort(torch.cat(self.idx))
+        return torch.cat(self.y_true)[order], torch.cat(self.y_prob)[order]
+
+    def sample_ids(self):
+        """Sample indices of `predictions`, in ascending order."""
+        return torch.sort(torch.cat(self.idx)).values
+
+    def compute(self):
+        """Scores as `get_metrics_probabilistic` with `criterion=None`.
+
+        Returns:
+            scores, cm, y_true, y_prob
+        """
+        y_true, y_prob = self.predictions()
+        scores = get_scores_from_cm(self.cm)
+        scores.update(get_scores_from_prob(y_true, y_prob))
+        return scores, self.cm, y_true, y_prob
+
+
+class PredictionHistory():
+    """Probabilities of a sample set at every evaluation.
+
+    Rows are appended to a preallocated `[capacity, num_samples]` float32
+    buffer whose capacity doubles when full, and the history is written once
+    by `save` as an NPZ file with the columns of the sample frame.
+
+    Args:
+        df: Sample frame, e.g., `df_vals[0]`. Rows are in the order of the
+            evaluated predictions.
+        capacity: Initial number of evaluations.
+    """
+    def __init__(self, df, capacity=16):
+        self.df = df
+        self.num_evals = 0
+        self._steps = np.zeros(capacity, dtype=np.int64)
+        self._probs = np.full((capacity, len(df)), np.nan, dtype=np.float32)
+
+    def __len__(self):
+        return self.num_evals
+
+    @property
+    def steps(self):
+        return self._steps[:self.num_evals]
+
+    @property
+    def probs(self):
+        return self._probs[:self.num_evals]
+
+    def append(self, step, probs, ids=None):
+        """Add the probabilities of evaluation at global step `step` of the
+        samples at rows `ids` of `df` (default: the first `len(probs)`).
+        Samples not evaluated (e.g., with limit_val_batches) are NaN.
+        """
+        if self.num_evals == len(self._steps):
+            capacity = 2 * max(len(self._steps), 1)
+            steps = np.zeros(capacity, dtype=np.int64)
+            buffer = np.full((capacity, self._probs.shape[1]), np.nan, dtype=np.float32)
+            steps[:self.num_evals] = self.steps
+            buffer[:self.num_evals] = self.probs
+            self._steps, self._probs = steps, buffer
+        probs = np.asarray(probs, dtype=np.float32)
+        if ids is None:
+            probs = probs[:self._probs.shape[1]]
+            ids = np.arange(len(probs))
+        self._steps[self.num_evals] = step
+        self._probs[self.num_evals, ids] = probs
+        self.num_evals += 1
+
+    def get(self, step):
+        """Probabilities of the last evaluation at `step`."""
+        rows = np.flatnonzero(self.steps == step)
+        if len(rows) == 0:
+            raise KeyError(f'No evaluation at step {step}')
+        return self.probs[rows[-1]]
+
+    def to_frame(self):
+        """Sample frame with a `step-{step}` column of every evaluation, as
+        the val_predictions.csv of earlier runs.
+        """
+        import pandas as pd
+        probs = pd.DataFrame(self.probs.T, index=self.df.index,
+                             columns=[f'step-{s}' for s in self.steps])
+        probs = probs.loc[:, ~probs.columns.duplicated(keep='last')]
+        return pd.concat([self.df, probs], axis=1)
+
+    def save(self, path):
+        """Write the history as NPZ. Object columns are stored as strings, so
+        that `load` does not need pickle.
+        """
+        columns = {}
+        for i, name in enumerate(self.df.columns):
+            values = self.df[name].to_numpy()
+            columns[f'column{i}'] = values.astype(str) if values.dtype == object else values
+        np.savez_compressed(path, steps=self.steps, probs=self.probs,
+                            index=self.df.index.to_numpy(),
+                            columns=np.array(self.df.columns, dtype=str), **columns)
+
+    @classmethod
+    def load(cls, path):
+        import pandas as pd
+        with np.load(path) as data:
+            df = pd.DataFrame({name: data[f'column{i}'] for i, name in enumerate(data['columns'])},
+                              index=data['index'])
+            history = cls(df, capacity=len(data['steps']))
+            history._steps[:] = data['steps']
+            history._probs[:] = data['probs']
+            history.num_evals = len(data['steps'])
+        return history
 
 
 def get_metrics_multiclass(i_true, i_pred):
@@ -56,38 +56,30 @@ def array_to_float_video(a, low=None, high=None, perc=True):
     return a
 
 
-def generate_batch_info_classification(videos, meta, y_true, y_prob):
+def generate_batch_info_classification(videos, meta, y_true, y_prob, df_sample):
     """
     Arguments: numpy arrays or list
+        meta: Sample ids, i.e., positions in `df_sample`.
+        df_sample: Sample data frame the batch was drawn from.
     Returns: Dataframe
     """
-    import os
     import numpy as np
     import pandas as pd
 
     axes = (1,2,3,4)
     y_prob_round = [round(p, 2) for p in y_prob]
+    samples = df_sample.iloc[np.asarray(meta)]
     d = {
         'min': np.min(videos, axis=axes), # if videos is tensor, axes is also expected to be
         '98-perc': np.percentile(videos, 98, axis=axes), # tried to convert arg to numpy ndarray
         'max': np.min(videos, axis=axes),
-        'idx': [],
-        'harp_num': [],
-        'start_time': [],
-        'h': [],
-        'w': [],
-        'flare': [],
+        'idx': np.asarray(meta),
+        'harp_num': samples['arpnum'].to_numpy(),
+        'start_time': samples['t_end'].to_numpy(),
+        'flare': [max(f.split('|')) for f in samples['flares']], #WARNING: X10+
         'y_true': y_true,
         'y_prob': y_prob_round,
     }
-    for m in meta:
-        info = os.path.basename(m).replace(".npy", "").split("_")
-        d['idx'].append(int(info[0]))
-        d['harp_num'].append(int(info[1][4:]))
-        d['start_time'].append(info[2])
-        d['h'].append(int(info[3][1:]))
-        d['w'].append(int(info[4][1:]))
-        d['flare'].append(info[5])
     df = pd.DataFrame(d)
     return df
 
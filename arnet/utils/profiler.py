@@ -1,8 +1,49 @@
+import time
 import cProfile
 import pstats
 
+
 class Profiler(cProfile.Profile):
     def __exit__(self, *exc_info):
         self.disable()
         self.ps = pstats.Stats(self)
         self.ps.sort_stats('cumtime').print_stats(30)
+
+
+def benchmark_dataloader(dataloader, num_batches=50, num_epochs=2):
+    """Measure the throughput of a dataloader.
+
+    Iterating more than one epoch shows the effect of persistent workers on
+    the time to first batch.
+
+    Returns:
+        stats (dict): Time to first batch of the first and the later epochs
+            (seconds) and the overall throughput (samples/s).
+    """
+    num_samples, t_total, ttfb = 0, 0.0, []
+    for _ in range(num_epochs):
+        t_start = time.time()
+        for i, batch in enumerate(dataloader):
+            if i == 0:
+                ttfb.append(time.time() - t_start)
+            num_samples += len(batch[-1]) # label or sample ids
+            if i + 1 >= num_batches:
+                break
+        t_total += time.time() - t_start
+    stats = {
+        'time_to_first_batch': ttfb[0],
+        'time_to_first_batch_later': sum(ttfb[1:]) / max(len(ttfb) - 1, 1),
+        'samples_per_sec': num_samples / t_total,
+    }
+    return stats
+
+
+def import_time(module, repeat=3):
+    """Wall time (seconds) to import `module` in a fresh interpreter, best of `repeat`."""
+    import sys
+    import subprocess
+
+    code = f'import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)'
+    times = [float(subprocess.check_output([sys.executable, '-c', code]))
+             for _ in range(repeat)]
+    return min(times)
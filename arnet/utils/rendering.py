@@ -0,0 +1,96 @@
+import logging
+import multiprocessing as mp
+from concurrent.futures import Future, ProcessPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+def render_figure(kind, data, tracking_uri, run_id, artifact_file):
+    """Draw a figure from arrays, log it to MLflow, and return it as an RGB array.
+
+    Runs in the worker process of `FigureRenderer`.
+
+    Args:
+        kind: One of 'conv2d_weight', 'confusion_matrix', 'reliability',
+            'roc', 'ssp'.
+        data: Dict of numpy arrays and options of the drawing function.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import torch
+    from mlflow.tracking import MlflowClient
+    from arnet.utils import visualization as vis
+
+    if kind == 'conv2d_weight':
+        fig = vis.draw_conv2d_weight(torch.from_numpy(data['weight']),
+                                     vmin=data.get('vmin'), vmax=data.get('vmax'))
+    elif kind == 'confusion_matrix':
+        fig = vis.draw_confusion_matrix(data['cm'])
+    else:
+        y_true, y_prob = torch.from_numpy(data['y_true']), torch.from_numpy(data['y_prob'])
+        if kind == 'reliability':
+            fig = vis.draw_reliability_plot(y_true, y_prob, n_bins=10)
+        elif kind == 'roc':
+            fig = vis.draw_roc(y_true, y_prob)
+        elif kind == 'ssp':
+            fig = vis.draw_ssp(y_true, y_prob)
+        else:
+            raise ValueError(f'Unknown figure {kind}')
+    MlflowClient(tracking_uri).log_figure(run_id, fig, artifact_file)
+    return vis.fig2rgb(fig) # closes the figure
+
+
+class FigureRenderer():
+    """Render evaluation figures in a background process.
+
+    `submit` returns immediately. Rendered images are returned by `collect`
+    to be added to TensorBoard in the main process.
+
+    Args:
+        num_workers: Number of worker processes. If 0, figures are rendered
+            synchronously in `submit`.
+    """
+    def __init__(self, run_id=None, tracking_uri=None, num_workers=1):
+        import mlflow
+        self.run_id = run_id or mlflow.active_run().info.run_id
+        self.tracking_uri = tracking_uri or mlflow.get_tracking_uri()
+        self.executor = None
+        if num_workers > 0:
+            # spawn: the trainer may hold CUDA contexts and threads
+            self.executor = ProcessPoolExecutor(num_workers, mp_context=mp.get_context('spawn'))
+        self.pending = [] # (future, tag, step)
+
+    def submit(self, kind, data, tag, step, artifact_file):
+        args = (kind, data, self.tracking_uri, self.run_id, artifact_file)
+        if self.executor is not None:
+            future = self.executor.submit(render_figure, *args)
+        else:
+            future = Future()
+            future.set_result(render_figure(*args))
+        self.pending.append((future, tag, step))
+
+    def collect(self, wait=False):
+        """Images of rendered figures as a list of (tag, image, step).
+
+        Args:
+            wait: Wait for all submitted figures.
+        """
+        done, pending = [], []
+        for future, tag, step in self.pending:
+            if wait or future.done():
+                try:
+                    done.append((tag, future.result(), step))
+                except Exception as e:
+                    logger.warning('Failed to render %s: %s', tag, e)
+            else:
+                pending.append((future, tag, step))
+        self.pending = pending
+        return done
+
+    def close(self):
+        done = self.collect(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        return done
@@ -0,0 +1,180 @@
+import os
+import time
+import atexit
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class MetricLogger():
+    """Buffered MLflow metric logger.
+
+    Metrics are queued in memory and sent with `MlflowClient.log_batch` from
+    a background thread every `interval` seconds, so that logging does not
+    write to the tracking store on the training step. Queued metrics are
+    flushed by `flush()`, `close()`, and at interpreter exit (including
+    after an uncaught exception).
+
+    Args:
+        run_id: MLflow run to log to. Defaults to the active run.
+        interval: Seconds between background flushes. If 0, every call is
+            sent synchronously.
+        enabled: If False, metrics are discarded, e.g., in processes other
+            than rank zero of distributed training.
+    """
+    MAX_BATCH = 1000 # metrics per log_batch call (MLflow limit)
+
+    def __init__(self, run_id=None, interval=5.0, enabled=True):
+        self.enabled = enabled
+        self.interval = interval
+        self._queue = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # keep batches in order
+        self._stop = threading.Event()
+        self._thread = None
+        if not enabled:
+            return
+        import mlflow
+        from mlflow.tracking import MlflowClient
+        self.client = MlflowClient()
+        self.run_id = run_id or mlflow.active_run().info.run_id
+        if interval > 0:
+            self._thread = threading.Thread(target=self._run, name='MetricLogger', daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def log_metric(self, key, value, step=None):
+        self.log_metrics({key: value}, step=step)
+
+    def log_metrics(self, metrics, step=None):
+        if not self.enabled:
+            return
+        from mlflow.entities import Metric
+        timestamp = int(time.time() * 1000)
+        entries = [Metric(k, float(v), timestamp, step or 0) for k, v in metrics.items()]
+        with self._lock:
+            self._queue.extend(entries)
+        if self.interval == 0:
+            self.flush()
+
+    def flush(self):
+        if not self.enabled:
+            return
+        with self._flush_lock:
+            with self._lock:
+                queue, self._queue = self._queue, []
+            for i in range(0, len(queue), self.MAX_BATCH):
+                self.client.log_batch(self.run_id, metrics=queue[i:i + self.MAX_BATCH])
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e: # keep training if the tracking server is unavailable
+                logger.warning('Failed to flush metrics: %s', e)
+
+    def close(self):
+        if not self.enabled:
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        atexit.unregister(self.close)
+
+
+class ArtifactSyncer():
+    """Upload the new or changed files of a directory as MLflow artifacts.
+
+    Files are compared by size and modification time with the last upload,
+    so repeated syncs of a growing log directory only upload what changed
+    since. MLflow artifacts cannot be appended to, so a file that grew (e.g.,
+    a TensorBoard event file) is uploaded again as a whole.
+
+    Args:
+        local_dir: Directory to sync.
+        artifact_path: Destination in the artifact store of the run.
+        run_id: MLflow run to log to. Defaults to the active run.
+    """
+    def __init__(self, local_dir, artifact_path=None, run_id=None):
+        import mlflow
+        from mlflow.tracking import MlflowClient
+        self.client = MlflowClient()
+        self.run_id = run_id or mlflow.active_run().info.run_id
+        self.local_dir = local_dir
+        self.artifact_path = artifact_path
+        self.synced = {} # relative path -> (size, mtime)
+
+    def sync(self, force=False):
+        """Upload new or changed files, or all files if `force`.
+
+        Returns:
+            uploaded: List of uploaded paths relative to `local_dir`.
+        """
+        uploaded = []
+        for root, _, files in os.walk(self.local_dir):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                rel_dir = os.path.relpath(root, self.local_dir)
+                rel_path = os.path.normpath(os.path.join(rel_dir, name))
+                stat = os.stat(path)
+                state = (stat.st_size, stat.st_mtime_ns)
+                if not force and self.synced.get(rel_path) == state:
+                    continue
+                artifact_path = self.artifact_path
+                if rel_dir != '.':
+                    artifact_path = os.path.join(artifact_path, rel_dir) if artifact_path else rel_dir
+                self.client.log_artifact(self.run_id, path, artifact_path)
+                self.synced[rel_path] = state
+                uploaded.append(rel_path)
+        return uploaded
+
+
+def get_child_run_id(run_name, tags=None, parent_run_id=None):
+    """Id of the child run of `parent_run_id` (default: the active run) named
+    `run_name`, created with `tags` if it does not exist.
+    """
+    import mlflow
+    from mlflow.tracking import MlflowClient
+    client = MlflowClient()
+    parent = client.get_run(parent_run_id or mlflow.active_run().info.run_id)
+    runs = client.search_runs([parent.info.experiment_id],
+                              filter_string=f"tags.`mlflow.parentRunId` = '{parent.info.run_id}' "
+                                            f"and tags.`mlflow.runName` = '{run_name}'")
+    if runs:
+        return runs[0].info.run_id
+    tags = dict(tags or {}, **{'mlflow.parentRunId': parent.info.run_id, 'mlflow.runName': run_name})
+    return client.create_run(parent.info.experiment_id, tags=tags).info.run_id
+
+
+def benchmark_metric_logging(num_steps=200, interval=5.0):
+    """Per-step time (seconds) of logging two metrics with `mlflow.log_metric`
+    and with `MetricLogger`, in a temporary run of the active experiment.
+    """
+    import mlflow
+
+    stats = {}
+    with mlflow.start_run(run_name='benchmark_metric_logging', nested=True):
+        t_start = time.time()
+        for step in range(num_steps):
+            mlflow.log_metric('bench/loss', 1.0 / (step + 1), step=step)
+            mlflow.log_metric('bench/epoch', 0, step=step)
+        stats['mlflow.log_metric'] = (time.time() - t_start) / num_steps
+
+        metric_logger = MetricLogger(interval=interval)
+        t_start = time.time()
+        for step in range(num_steps):
+            metric_logger.log_metric('bench_buffered/loss', 1.0 / (step + 1), step=step)
+            metric_logger.log_metric('bench_buffered/epoch', 0, step=step)
+        stats['MetricLogger'] = (time.time() - t_start) / num_steps
+        metric_logger.close()
+    return stats
+
+
+if __name__ == '__main__':
+    # python -m arnet.utils.tracking
+    for name, t in benchmark_metric_logging().items():
+        print(f'{name:<20} {t * 1e3:8.3f} ms/step')
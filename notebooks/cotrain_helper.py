@@ -20,7 +20,7 @@ from tqdm import tqdm
 
 from arnet.modeling.learner import Learner
 from arnet.dataset import ActiveRegionDataModule
-from mlflow_helper import retrieve, paired_ttest, get_labels_probs
+from mlflow_helper import retrieve, paired_ttest, get_labels_probs, read_predictions
 retrieve = lru_cache(retrieve)
 from dashboard_helper import get_learner, inspect_runs, predict, get_transform_from_learner
 
@@ -186,11 +186,11 @@ def get_val_csv(run, get_train: bool, rus=True, discard=True):
         df_val = add_prob_col(dm.df_vals[0])
         df_test = add_prob_col(dm.df_test)
     else:
-        df_val = pd.read_csv(Path(artifact_uri) / 'validation0' / 'val_predictions.csv', index_col=0)
+        df_val = read_predictions(artifact_uri, 'validation0')
         df_val = df_val.rename(columns={f'step-{step}': 'prob'})
         df_val = df_val[[col for col in df_val.columns if 'step-' not in col]]
         
-        df_test = pd.read_csv(Path(artifact_uri) / 'validation1' / 'val_predictions.csv', index_col=0)
+        df_test = read_predictions(artifact_uri, 'validation1')
         df_test = df_test.rename(columns={f'step-{step}': 'prob'})
         df_test = df_test[[col for col in df_test.columns if 'step-' not in col]]
 
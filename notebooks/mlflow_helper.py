@@ -352,6 +352,19 @@ def unstack_reps(runs_raw, index_cols=None, rep_col=None, metric_cols=None):
     return df
 
 
+def read_predictions(artifact_uri, tag, name='val_predictions'):
+    """Prediction history of `tag` (e.g., 'validation0') as a frame with a
+    `step-{step}` column of every evaluation. Reads `{name}.npz`, or the
+    `{name}.csv` of earlier runs.
+    """
+    import os
+    from arnet.utils import PredictionHistory
+    path = os.path.join(artifact_uri, tag, name + '.npz')
+    if os.path.exists(path):
+        return PredictionHistory.load(path).to_frame()
+    return pd.read_csv(os.path.join(artifact_uri, tag, name + '.csv'), index_col=0)
+
+
 def get_labels_probs(query, split, correct_prob=None, return_df=False):
     """
     Args:
@@ -419,16 +432,13 @@ def get_labels_probs(query, split, correct_prob=None, return_df=False):
         #    df = _df.assign(prob=y_prob)
         #    df.to_csv(csv_full)
 
-        ## Use original val_predictions.csv
-        csv_full = os.path.join(artifact_uri, 'validation0', 'val_predictions.csv')
-
-        df = pd.read_csv(csv_full, index_col=0)
+        ## Use original val_predictions
+        df = read_predictions(artifact_uri, 'validation0')
         #probs = df[f'prob'].values # for val_predictions_full.csv
-        probs = df[f'step-{step}'].values # for val_predictions.csv
+        probs = df[f'step-{step}'].values # for val_predictions
         labels = df['label'].values.astype(int)
     elif split == 'test':
-        csv = os.path.join(artifact_uri, 'validation1', 'val_predictions.csv')
-        df = pd.read_csv(csv, index_col=0)
+        df = read_predictions(artifact_uri, 'validation1')
         probs = df[f'step-{step}'].values
         labels = df['label'].values.astype(int)
     probs = correct_prob(probs, labels)
@@ -9,7 +9,8 @@ import numpy as np
 import pandas as pd
 
 from arnet.utils import read_header, query_images
-from utils import get_flare_index
+from arnet.fusion import assign_cv_folds
+from utils import get_flare_index, get_flare_classes, get_peak_intensity
 
 
 def get_prefix(dataset):
@@ -78,6 +79,7 @@ def get_label(flares_observed, flares_future, criterion='M_Q'):
 
     activities = [None, None]
     for i, flares in enumerate([flares_observed, flares_future]):
+        flares = get_flare_classes(flares) # as get_peak_intensity
         if len(flares) == 0:
             activities[i] = 'Q'
         elif any([T in ''.join(flares) for T in large_class]):
@@ -189,19 +191,23 @@ def select_per_arp(dataset, arpnum,
 
         bad_img_idx = (np.where(df_new['bad_img'])[0] - 16)  # neg idx of bad images
 
-        flares_future = goes_ar.loc[(goes_ar['start_time'] >= t_end.strftime(GOES_TIME_FORMAT)) &
-                                    (goes_ar['start_time'] <= t_future.strftime(GOES_TIME_FORMAT)),
-                                    'goes_class'].tolist()
+        future = goes_ar.loc[(goes_ar['start_time'] >= t_end.strftime(GOES_TIME_FORMAT)) &
+                             (goes_ar['start_time'] <= t_future.strftime(GOES_TIME_FORMAT)),
+                             ['start_time', 'goes_class']]
+        flares_future = future['goes_class'].tolist()
         flares_observed = goes_ar.loc[(goes_ar['start_time'] >= t_start.strftime(GOES_TIME_FORMAT)) &
                                       (goes_ar['start_time'] <= t_end.strftime(GOES_TIME_FORMAT)),
                                       'goes_class'].tolist()
         flare_index = get_flare_index(flares_observed)
 
         # (3) Drop the negative sample with large observed flares
-        label, evolution = get_label(flares_observed, flares_future, criterion)
-        if label is None:
-            counter['obs_pos'] += 1
-            continue
+        # No criterion: keep all samples in a master table
+        label, evolution = None, None
+        if criterion is not None:
+            label, evolution = get_label(flares_observed, flares_future, criterion)
+            if label is None:
+                counter['obs_pos'] += 1
+                continue
 
         sample = {
             'prefix': get_prefix(dataset),
@@ -220,6 +226,14 @@ def select_per_arp(dataset, arpnum,
             'FLARE_INDEX': flare_index,
         }
         sample.update({k: df_new[k].iloc[-1] for k in KEYWORDS})
+        if criterion is None:
+            # Labels are assigned at load time by arnet.fusion.apply_criterion
+            del sample['label'], sample['evolution']
+            sample['obs_peak'] = get_peak_intensity(flares_observed)
+            for h in HORIZONS:
+                t_h = (t_end + timedelta(hours=h)).strftime(GOES_TIME_FORMAT)
+                flares_h = future.loc[future['start_time'] <= t_h, 'goes_class']
+                sample[f'future_peak_{h}hr'] = get_peak_intensity(flares_h)
         samples.append(sample)
     logger.info('{} {}: {}/{} sequences extracted. {}'.format(
         get_prefix(dataset), arpnum, len(samples), len(df), dict(counter)))
@@ -265,6 +279,9 @@ def main(split_num, output_dir, val_time, criterion):
         logger.info(dataset)
         arpnums = get_arpnums(dataset)
         df = select(dataset, arpnums, val_time, criterion)
+        if criterion is not None:
+            # Folds of a master table depend on the criterion; see fusion.load_database
+            df = assign_cv_folds(df, cv=split_num)
         df.to_csv(os.path.join(output_dir, f'{dataset}.csv'), index=False)
 
 
@@ -273,6 +290,8 @@ if __name__ == '__main__':
     parser.add_argument('--raw_data_dir', default='/data2')
     parser.add_argument('--processed_data_dir', default='datasets')
     parser.add_argument('--seed', default=0)
+    parser.add_argument('--master', action='store_true',
+                        help='Write one master table with peak flare intensities instead of one directory per criterion')
     args = parser.parse_args()
 
     # global variables
@@ -282,6 +301,7 @@ if __name__ == '__main__':
     T_REC_MAX = datetime(year=2020, month=12, day=1).strftime(T_REC_FORMAT)
     OBS_TIME = timedelta(days=1)  # observation time
     KEYWORDS = ['AREA', 'USFLUXL', 'MEANGBL', 'R_VALUE']
+    HORIZONS = [6, 12, 24, 48]  # hours. Prediction windows in the master table
 
     GOES_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000'
     GOES = pd.read_csv(os.path.join(args.raw_data_dir, 'GOES/goes.csv'))
@@ -301,6 +321,15 @@ if __name__ == '__main__':
     # raise
 
     # begin preprocessing
+    if args.master:
+        # Flares in the longest horizon are listed in 'flares'
+        logger.info('master')
+        main(split_num=5,
+             output_dir='master',
+             val_time=timedelta(hours=max(HORIZONS)),
+             criterion=None)
+        raise SystemExit
+
     for criterion in ['M_Q', 'M_QS', 'M_QSL']:
         for val_hours in [24]:
             output_dir = f'{criterion}_{val_hours}hr'
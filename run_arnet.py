@@ -1,9 +1,14 @@
+import os
+import sys
 import time
 import argparse
+import itertools
 import cProfile, pstats
 from pathlib import Path
+import pandas as pd
 import mlflow
 import pytorch_lightning as pl
+from pytorch_lightning.utilities import rank_zero_only
 
 from arnet import utils
 from arnet.dataset import ActiveRegionDataModule
@@ -35,6 +40,13 @@ def train(cfg, dm, resume=False):
         ),
         #pl.callbacks.ModelPruning("l1_unstructured", amount=0.5),
     ]
+    if cfg.LEARNER.THROUGHPUT.ENABLED:
+        callbacks.append(utils.ThroughputMonitor(
+            window=cfg.LEARNER.THROUGHPUT.WINDOW,
+            log_every_n_steps=cfg.LEARNER.THROUGHPUT.LOG_EVERY_N_STEPS,
+            input_bound_ratio=cfg.LEARNER.THROUGHPUT.INPUT_BOUND_RATIO,
+            sync_cuda=cfg.LEARNER.THROUGHPUT.SYNC_CUDA,
+        ))
     # log_hparams in tensorboard
     #tb_logger = pl.loggers.TensorBoardLogger(save_dir, default_hp_metric=False)
     #how to get save_dir before init trainer?
@@ -59,6 +71,199 @@ def test(cfg, dm):
     trainer.test(learner, datamodule=dm)
 
 
+def bench_data(cfg, dm, num_batches=50):
+    """Benchmark the training dataloader over a grid of loader settings.
+
+    Worker, prefetch and persistent-worker settings are tuned at the
+    configured batch size, and the fastest are written back into `cfg`.
+    Half and double batch sizes are then measured with the best settings and
+    only reported, since they change the optimization. In-memory loaders
+    (parameter-only features) have no workers, so only batch sizes are
+    measured.
+    """
+    batch_size = cfg.DATA.BATCH_SIZE
+    batch_sizes = [batch_size // 2, batch_size * 2]
+    max_workers = os.cpu_count() or 1
+    if dm.in_memory and not cfg.DATA.EMBEDDING_DIR:
+        grid = [(0, 2, False)]
+    else:
+        grid = [(0, 2, False)] + list(itertools.product(
+            sorted({w for w in [2, 4, 8] if w <= max_workers}), # NUM_WORKERS
+            [2, 4], # PREFETCH_FACTOR
+            [False, True], # PERSISTENT_WORKERS
+        ))
+
+    def measure(num_workers, prefetch_factor, persistent, bs):
+        dm.cfg = cfg.clone()
+        dm.cfg.DATA.NUM_WORKERS = num_workers
+        dm.cfg.DATA.PREFETCH_FACTOR = prefetch_factor
+        dm.cfg.DATA.BATCH_SIZE = bs
+        dm.cfg.DATA.PERSISTENT_WORKERS = persistent
+        loader = dm.get_dataloader(dm.df_train, shuffle=True, drop_last=True)
+        stats = utils.benchmark_dataloader(loader, num_batches=num_batches)
+        del loader # shut down persistent workers
+        r = {
+            'NUM_WORKERS': num_workers,
+            'PREFETCH_FACTOR': prefetch_factor,
+            'BATCH_SIZE': bs,
+            'PERSISTENT_WORKERS': persistent,
+        }
+        r.update(stats)
+        logger.info(r)
+        return r
+
+    cfg_orig = dm.cfg
+    results = [measure(*settings, batch_size) for settings in grid]
+    best = max(results, key=lambda r: r['samples_per_sec'])
+    results += [measure(best['NUM_WORKERS'], best['PREFETCH_FACTOR'], best['PERSISTENT_WORKERS'], bs)
+                for bs in batch_sizes]
+    dm.cfg = cfg_orig
+
+    df = pd.DataFrame(results).sort_values('samples_per_sec', ascending=False)
+    cfg.DATA.NUM_WORKERS = int(best['NUM_WORKERS'])
+    cfg.DATA.PREFETCH_FACTOR = int(best['PREFETCH_FACTOR'])
+    cfg.DATA.PERSISTENT_WORKERS = bool(best['PERSISTENT_WORKERS'])
+    logger.info("Dataloader throughput:\n" + df.to_markdown(index=False))
+
+    mlflow.log_text(df.to_markdown(index=False), 'bench_data/throughput.md')
+    mlflow.log_text(df.to_csv(index=False), 'bench_data/throughput.csv')
+    mlflow.log_text(cfg.dump(), 'bench_data/config.yaml')
+    return df
+
+
+def bench_vis(cfg, dm, num_steps=50):
+    """Training steps per second under each training diagnostics profile
+    (cfg.LEARNER.VIS.PROFILE), each in a nested MLflow run.
+    """
+    from arnet.modeling.learner import VIS_PROFILES
+    results = []
+    for profile in VIS_PROFILES:
+        cfg_profile = cfg.clone()
+        cfg_profile.LEARNER.VIS.PROFILE = profile
+        timer = utils.get_step_timer()
+        kwargs = cfg_profile.TRAINER.todict()
+        kwargs.update({
+            'max_epochs': 1,
+            'limit_train_batches': num_steps,
+            'limit_val_batches': 0,
+            'num_sanity_val_steps': 0,
+            'enable_checkpointing': False,
+            'callbacks': [timer],
+        })
+        with mlflow.start_run(run_name=f'bench_vis_{profile}', nested=True):
+            trainer = pl.Trainer(**kwargs)
+            trainer.fit(Learner(cfg_profile), datamodule=dm)
+        r = {'PROFILE': profile, 'steps_per_sec': timer.steps_per_sec}
+        logger.info(r)
+        results.append(r)
+
+    df = pd.DataFrame(results)
+    logger.info("Training step throughput:\n" + df.to_markdown(index=False))
+    mlflow.log_text(df.to_markdown(index=False), 'bench_vis/throughput.md')
+    mlflow.log_text(df.to_csv(index=False), 'bench_vis/throughput.csv')
+    return df
+
+
+def bench_resize(cfg):
+    """Best validation TSS, epoch time, and transform throughput of the video
+    resize transforms, and of size bucketing with adaptive pooling instead of
+    resizing, each trained in a nested MLflow run. Requires MAGNETOGRAM in
+    cfg.DATA.FEATURES.
+    """
+    from mlflow.tracking import MlflowClient
+    from arnet.transforms import benchmark_resize
+    client = MlflowClient()
+    spatial = ['Resize', 'FrameResize', 'CenterCropPad']
+    transforms = [t for t in cfg.DATA.TRANSFORMS if t not in spatial]
+    variants = [ # name, run name, cfg options
+        ('Resize', 'Resize', ['DATA.TRANSFORMS', ['Resize'] + transforms]), # trilinear grid_sample
+        ('FrameResize (area)', 'FrameResize_area',
+         ['DATA.TRANSFORMS', ['FrameResize'] + transforms, 'DATA.RESIZE_MODE', 'area']),
+        ('FrameResize (bilinear)', 'FrameResize_bilinear',
+         ['DATA.TRANSFORMS', ['FrameResize'] + transforms, 'DATA.RESIZE_MODE', 'bilinear']),
+        ('Bucketing + adaptive pool', 'bucketing',
+         ['DATA.TRANSFORMS', transforms, 'DATA.BUCKETING', True, 'LEARNER.MODEL.ADAPTIVE_POOL', True]),
+    ]
+    videos_per_sec = benchmark_resize(target_size=(cfg.DATA.HEIGHT, cfg.DATA.WIDTH))
+    results = []
+    for name, run_name, opts in variants:
+        cfg_variant = cfg.clone()
+        cfg_variant.merge_from_list(opts)
+        with mlflow.start_run(run_name=f'bench_resize_{run_name}', nested=True) as run:
+            dm = ActiveRegionDataModule(cfg_variant)
+            cfg_variant = dm.set_class_weight(cfg_variant)
+            train(cfg_variant, dm)
+        tss = client.get_metric_history(run.info.run_id, 'validation0/tss')
+        epoch_time = client.get_metric_history(run.info.run_id, 'train/epoch_time')
+        r = {
+            'transform': name,
+            'best_tss': max([m.value for m in tss], default=float('nan')),
+            'epoch_time': pd.Series([m.value for m in epoch_time], dtype=float).mean(),
+            'videos_per_sec': videos_per_sec.get(name, float('nan')), # no resize when bucketing
+        }
+        logger.info(r)
+        results.append(r)
+
+    df = pd.DataFrame(results)
+    logger.info("Resize transforms:\n" + df.to_markdown(index=False))
+    mlflow.log_text(df.to_markdown(index=False), 'bench_resize/results.md')
+    mlflow.log_text(df.to_csv(index=False), 'bench_resize/results.csv')
+    return df
+
+
+def bench_ddp(config, opts, num_processes=(1, 2, 4), num_steps=50):
+    """Training throughput of CPU DDP over gloo with each number of processes.
+
+    Every setting trains in a `run_arnet.py` process that logs a nested
+    MLflow run, with the CPU cores split evenly among its DDP processes.
+    """
+    from subprocess import run
+    from mlflow.tracking import MlflowClient
+    client = MlflowClient()
+    parent_run_id = mlflow.active_run().info.run_id
+    results = []
+    for n in num_processes:
+        run_name = f'bench_ddp_{n}'
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '--experiment_name', mlflow.get_experiment(mlflow.active_run().info.experiment_id).name,
+               '--run_name', run_name,
+               '--modes', 'train',
+               '--parent_run_id', parent_run_id]
+        if config is not None:
+            cmd += ['--config', config]
+        cmd += [str(o) for o in opts] + [
+            'TRAINER.accelerator', 'cpu',
+            'TRAINER.strategy', 'ddp' if n > 1 else 'None',
+            'TRAINER.num_processes', n,
+            'TRAINER.gpus', 0,
+            'TRAINER.precision', 32,
+            'TRAINER.max_epochs', 1,
+            'TRAINER.limit_train_batches', num_steps,
+            'TRAINER.limit_val_batches', 2,
+            'LEARNER.THROUGHPUT.ENABLED', True,
+            'LEARNER.THROUGHPUT.LOG_EVERY_N_STEPS', max(1, num_steps // 5),
+        ]
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = str(max(1, (os.cpu_count() or 1) // n))
+        t_start = time.time()
+        returncode = run([str(c) for c in cmd], env=env).returncode
+        r = {'num_processes': n, 'returncode': returncode, 'time': time.time() - t_start}
+        if returncode == 0:
+            metrics = client.get_run(utils.get_child_run_id(run_name)).data.metrics
+            # throughput of rank zero, whose batches are 1/n of the global batches
+            r['samples_per_sec'] = metrics.get('throughput/samples_per_sec', float('nan')) * n
+        logger.info(r)
+        results.append(r)
+
+    df = pd.DataFrame(results)
+    if 'samples_per_sec' in df:
+        df['speedup'] = df['samples_per_sec'] / df['samples_per_sec'].iloc[0]
+    logger.info("DDP training throughput:\n" + df.to_markdown(index=False))
+    mlflow.log_text(df.to_markdown(index=False), 'bench_ddp/throughput.md')
+    mlflow.log_text(df.to_csv(index=False), 'bench_ddp/throughput.csv')
+    return df
+
+
 def launch(config, modes, resume, opts):
     """Perform training, testing, and/or visualization"""
     logger.info("======== LAUNCH ========")
@@ -71,9 +276,42 @@ def launch(config, modes, resume, opts):
     dm = ActiveRegionDataModule(cfg) # datamodule construction also changes transformation params
     cfg = dm.set_class_weight(cfg)
 
-    mlflow.log_params({key: val
-                       for key, val in cfg.flatten().items()
-                       if key != 'LEARNER.CHECKPOINT'})
+    # Processes of DDP training rerun this script. Only rank zero prepares
+    # data, benchmarks, and logs the params.
+    is_rank_zero = rank_zero_only.rank == 0
+
+    if 'write_shards' in modes and is_rank_zero:
+        logger.info("======== WRITE SHARDS ========")
+        index = dm.write_shards()
+        logger.info("%d samples in %d shards at %s" % (
+            len(index), index['shard'].nunique(), cfg.DATA.SHARD_DIR))
+
+    if 'embed' in modes and is_rank_zero:
+        logger.info("======== EMBED ========")
+        embeddings = dm.compute_embeddings()
+        logger.info("%d frames of dimension %d at %s" % (
+            *embeddings.shape, cfg.DATA.EMBEDDING_DIR))
+
+    if 'bench_data' in modes and is_rank_zero:
+        logger.info("======== BENCH DATA ========")
+        bench_data(cfg, dm)
+
+    if 'bench_vis' in modes and is_rank_zero:
+        logger.info("======== BENCH VIS ========")
+        bench_vis(cfg, dm)
+
+    if 'bench_resize' in modes and is_rank_zero:
+        logger.info("======== BENCH RESIZE ========")
+        bench_resize(cfg)
+
+    if 'bench_ddp' in modes and is_rank_zero:
+        logger.info("======== BENCH DDP ========")
+        bench_ddp(config, opts)
+
+    if is_rank_zero:
+        mlflow.log_params({key: val
+                           for key, val in cfg.flatten().items()
+                           if key != 'LEARNER.CHECKPOINT'})
     logger.info(cfg)
     logger.info("{} {} {}".format(
         cfg.DATA.DATABASE,
@@ -84,8 +322,9 @@ def launch(config, modes, resume, opts):
     if 'train' in modes:
         logger.info("======== TRAIN ========")
         cfg.LEARNER.CHECKPOINT = train(cfg, dm, resume)
-        mlflow.set_tag('checkpoint', cfg.LEARNER.CHECKPOINT)
-        mlflow.log_param('LEARNER.CHECKPOINT', cfg.LEARNER.CHECKPOINT) # update
+        if is_rank_zero:
+            mlflow.set_tag('checkpoint', cfg.LEARNER.CHECKPOINT)
+            mlflow.log_param('LEARNER.CHECKPOINT', cfg.LEARNER.CHECKPOINT) # update
         logger.info("Checkpoint saved at %s" % cfg.LEARNER.CHECKPOINT)
 
     if 'test' in modes:
@@ -104,17 +343,26 @@ def main():
     parser.add_argument('--config', metavar='FILE',
                         help="Path to a yaml formatted config file")
     parser.add_argument('--modes', default='train|test',
-                        help="Perform training and/or testing")
+                        help="Perform training and/or testing. 'bench_data' tunes the dataloader first. "
+                             "'write_shards' packs training samples into DATA.SHARD_DIR. "
+                             "'embed' writes frame embeddings into DATA.EMBEDDING_DIR. "
+                             "'bench_vis' measures training steps/sec under each LEARNER.VIS.PROFILE. "
+                             "'bench_resize' compares validation TSS, epoch time and videos/sec of Resize, FrameResize, and bucketing. "
+                             "'bench_ddp' measures CPU DDP training throughput with 1, 2, and 4 processes")
     parser.add_argument('--resume', metavar='CHECKPOINT',
                         help="Resume training from checkpoint. Valid only in training mode.")
+    parser.add_argument('--parent_run_id',
+                        help="Nest the MLflow run in this run, e.g., a sweep")
+    parser.add_argument('--tag', action='append', default=[], metavar='KEY=VALUE',
+                        help="MLflow run tag. May be repeated")
     parser.add_argument('opts', default=None, nargs=argparse.REMAINDER,
                         help="Modify config options. Use dot(.) to indicate hierarchy.")
     args = parser.parse_args()
     args.modes = args.modes.split('|')
-    accepted_modes = ['train', 'test']
+    accepted_modes = ['train', 'test', 'bench_data', 'bench_vis', 'bench_resize', 'bench_ddp', 'write_shards', 'embed']
     if any([m not in accepted_modes for m in args.modes]):
         raise AssertionError('Mode {} is not accepted'.format(args.modes))
-    if 'train' not in args.modes and 'LEARNER.CHECKPOINT' not in args.opts:
+    if 'test' in args.modes and 'train' not in args.modes and 'LEARNER.CHECKPOINT' not in args.opts:
         raise ValueError('LEARNER.CHECKPOINT must be specified in the absence of training mode.')
     if args.smoke:
         args.experiment_name = 'smoke_arnet'
@@ -126,18 +374,39 @@ def main():
             'TRAINER.default_root_dir', 'lightning_logs_dev'
         ])
 
+    tags = dict(t.split('=', 1) for t in args.tag)
+    if args.parent_run_id:
+        tags['mlflow.parentRunId'] = args.parent_run_id
+    if rank_zero_only.rank != 0:
+        # DDP processes rerun this script. Only rank zero starts, logs to, and
+        # ends the run, so that other ranks cannot terminate it early.
+        launch(args.config, args.modes, args.resume, args.opts)
+        return
     mlflow.set_experiment(experiment_name=args.experiment_name)
-    with mlflow.start_run(run_name=args.run_name) as run:
+    with mlflow.start_run(run_name=args.run_name, tags=tags) as run:
+        tt = time.time()
         launch(args.config, args.modes, args.resume, args.opts)
+        mlflow.log_metric('time', time.time() - tt)
 
 
 def sweep():
+    """Train and test over a grid of databases, datasets, configs, seeds and
+    splits, in parallel processes (see arnet.scheduler). Jobs that finished in
+    the experiment are skipped, so an interrupted sweep resumes by rerunning.
+    """
+    from arnet.scheduler import SweepScheduler, expand_grid, get_completed_jobs
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--data_root', default='datasets')
     parser.add_argument('-c', '--config_root', default='arnet/configs')
     parser.add_argument('-s', '--smoke', action='store_true')
     parser.add_argument('-e', '--experiment_name', default='leaderboard8')
     parser.add_argument('-r', '--run_name', default='reproduce')
+    parser.add_argument('--max_cpus', type=int, help='Defaults to all cores')
+    parser.add_argument('--cpus_per_job', type=int, default=4)
+    parser.add_argument('--max_memory', type=float, help='GB. Defaults to physical memory')
+    parser.add_argument('--memory_per_job', type=float, default=8, help='GB')
+    parser.add_argument('--gpus', type=int, default=0, help='If positive, one GPU per job')
+    parser.add_argument('--max_jobs', type=int, help='Maximum number of concurrent jobs')
     parser.add_argument('opts', default=None, nargs=argparse.REMAINDER)
     args = parser.parse_args()
     if args.smoke:
@@ -163,32 +432,17 @@ def sweep():
     test_splits = [None] #range(5)
     val_splits = [None] #range(5)
     seeds = range(num_seeds)
+    jobs = expand_grid(databases, datasets, configs, seeds, test_splits, val_splits,
+                       balanced=[True], opts=args.opts)
+    completed = get_completed_jobs(args.experiment_name)
     mlflow.set_experiment(args.experiment_name)
-    with mlflow.start_run(run_name=args.run_name):
-        for database in databases:
-            for balanced in [True]:
-                for dataset in datasets:
-                    for config in configs:
-                        for seed in seeds:
-                            for test_split in test_splits:
-                                for val_split in val_splits:
-                                    opts = [
-                                        'DATA.DATABASE', database,
-                                        'DATA.DATASET', dataset,
-                                        'DATA.BALANCED', balanced,
-                                        'DATA.SEED', seed, # used in data rus and training
-                                        'DATA.TEST_SPLIT', test_split,
-                                        'DATA.VAL_SPLIT', val_split,
-                                    ]
-                                    run_name = '_'.join([database.name, config.stem, dataset])
-                                    with mlflow.start_run(run_name=run_name, nested=True):
-                                        tt = time.time()
-                                        launch(config, 'train|test', False, args.opts + opts)
-                                        mlflow.log_metric('time', time.time() - tt)
-                                        mlflow.set_tag('database_name', database.name)
-                                        mlflow.set_tag('balanced', balanced)
-                                        mlflow.set_tag('estimator_name', config.stem)
-                                        mlflow.set_tag('dataset_name', dataset)
+    with mlflow.start_run(run_name=args.run_name) as run:
+        scheduler = SweepScheduler(jobs, args.experiment_name, run.info.run_id,
+                                   max_cpus=args.max_cpus, cpus_per_job=args.cpus_per_job,
+                                   max_memory=args.max_memory, memory_per_job=args.memory_per_job,
+                                   gpus=args.gpus, max_jobs=args.max_jobs)
+        failed = scheduler.run(completed=completed)
+        mlflow.log_metric('failed_jobs', len(failed))
 
     print('Run time: {} s'.format(time.time() - t_start))
 
@@ -30,6 +30,8 @@ from xgboost import XGBClassifier
 from metrics import tss, hss2, roc_auc_score, get_scores_from_cm, optimal_tss, draw_ssp
 from utils import get_output
 from arnet.fusion import get_datasets
+from arnet.image_features import IMAGE_FEATURES
+from arnet.sequence_features import SEQUENCE_FEATURES
 
 
 def standardize_data(X_train, X_test):
@@ -47,12 +49,14 @@ def get_dataset_from_df(df):
     return X, y, groups
 
 
-def get_dataset_numpy(database, dataset, auxdata, balanced=False, seed=None):
+def get_dataset_numpy(database, dataset, auxdata, balanced=False, seed=None,
+                      criterion=None, horizon=None):
     if cfg['smoke']:
         balanced = {0: 50, 1: 50}
 
     df_train, df_test = get_datasets(database, dataset, auxdata,
-                                     balanced=balanced, validation=False, shuffle=True, seed=seed)
+                                     balanced=balanced, validation=False, shuffle=True, seed=seed,
+                                     criterion=criterion, horizon=horizon)
     X_train, y_train, g_train = get_dataset_from_df(df_train)
     X_test, y_test, g_test = get_dataset_from_df(df_test)
 
@@ -209,11 +213,14 @@ def tune(X_train, y_train, groups_train,
     return search, df
 
 
-def sklearn_main(database_dir):
+def sklearn_main(database_dir, criterion=None, horizon=None):
     """
     We sweep both dataset and model in this function because that's the key comparisons
     made by the paper. Databases, on the other hand, is iterated outside this function.
+
+    If `criterion` is given, `database_dir` is a master table labeled at load time.
     """
+    database_name = database_dir.name if criterion is None else f'{criterion}_{horizon}hr'
     Models = [
         #KNeighborsClassifier,
         #QuadraticDiscriminantAnalysis,
@@ -317,10 +324,11 @@ def sklearn_main(database_dir):
             for cfg['seed'] in range(5):
                 dataset_blc = dataset + '_' + ('balanced' if balanced else 'raw')
                 X_train, X_test, y_train, y_test, groups_train, _ = get_dataset_numpy(
-                    database_dir, dataset, cfg['auxdata'], balanced=balanced, seed=cfg['seed'])
+                    database_dir, dataset, cfg['auxdata'], balanced=balanced, seed=cfg['seed'],
+                    criterion=criterion, horizon=horizon)
                 # # Visualize processed train and test splits
                 # from eda import plot_selected_samples
-                # title = database_dir.name + ' ' + dataset_blc
+                # title = database_name + ' ' + dataset_blc
                 # fig = plot_selected_samples(X_train, X_test, y_train, y_test, cfg['features'],
                 #                             title=title)
                 # fig.show()
@@ -329,7 +337,7 @@ def sklearn_main(database_dir):
                     t_start = time.time()
                     param_space = distributions[Model.__name__]
 
-                    run_name = '_'.join([database_dir.name, dataset_blc, Model.__name__])
+                    run_name = '_'.join([database_name, dataset_blc, Model.__name__])
                     run_dir = Path(cfg['output_dir']) / run_name
                     run_dir.mkdir(parents=True, exist_ok=True)
                     with mlflow.start_run(run_name=run_name, nested=True) as run:
@@ -346,7 +354,7 @@ def sklearn_main(database_dir):
                         #mlflow.log_param('sampling_strategy', best_model.best_params_['rus__sampling_strategy'])
                         mlflow.log_params({k.replace('model__', ''): v for k, v in
                             best_model.best_params_.items() if k.startswith('model__')})
-                        mlflow.set_tag('database_name', database_dir.name)
+                        mlflow.set_tag('database_name', database_name)
                         mlflow.set_tag('dataset_name', dataset)
                         mlflow.set_tag('balanced', balanced)
                         mlflow.set_tag('estimator_name', Model.__name__)
@@ -355,7 +363,7 @@ def sklearn_main(database_dir):
                         #mlflow.sklearn.log_model(best_model, 'mlflow_model')
 
                     r = {
-                        'database': database_dir.name,
+                        'database': database_name,
                         'dataset': dataset_blc,
                         'model': Model.__name__,
                         'time': time.time() - t_start,
@@ -368,7 +376,7 @@ def sklearn_main(database_dir):
                     results.append(r)
 
     results_df = pd.DataFrame(results)
-    save_path = Path(cfg['output_dir']) / f'{database_dir.name}_results.md'
+    save_path = Path(cfg['output_dir']) / f'{database_name}_results.md'
     results_df.to_markdown(save_path, tablefmt='grid')
     results_df.to_csv(save_path.with_suffix('.csv'))
     print(results_df.to_markdown(tablefmt='grid'))
@@ -390,6 +398,12 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--run_name', default='sklearn')
     parser.add_argument('-o', '--output_dir', default='outputs')
     parser.add_argument('--seed', default=0)
+    parser.add_argument('--image_features', action='store_true',
+                        help='Add features of python -m arnet.image_features')
+    parser.add_argument('--sequence_features', action='store_true',
+                        help='Add features of python -m arnet.sequence_features')
+    parser.add_argument('--criteria', nargs='*', default=None,
+                        help='Label the master table under criteria, e.g., M_Q_24hr M_QS_12hr')
     args = parser.parse_args()
 
     cfg = {
@@ -402,6 +416,10 @@ if __name__ == '__main__':
         },
     }
     cfg.update(vars(args))
+    if args.image_features:
+        cfg['features'] = cfg['features'] + IMAGE_FEATURES
+    if args.sequence_features:
+        cfg['features'] = cfg['features'] + SEQUENCE_FEATURES
     if args.smoke:
         cfg.update({
             'experiment_name': 'smoke',
@@ -424,8 +442,15 @@ if __name__ == '__main__':
             'M_Q_24hr',
             'M_QS_24hr',
         ]]
-        logging.info(databases)
-        for database in databases:
-            sklearn_main(database)
+        if cfg['criteria']:
+            # One master table, labeled at load time
+            for criterion_horizon in cfg['criteria']:
+                thresh, neg, horizon = criterion_horizon.split('_')
+                sklearn_main(Path(cfg['data_root']) / 'master',
+                             criterion=f'{thresh}_{neg}', horizon=int(horizon.rstrip('hr')))
+        else:
+            logging.info(databases)
+            for database in databases:
+                sklearn_main(database)
 
     print('Run time: {} s'.format(time.time() - t_start))
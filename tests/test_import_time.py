@@ -0,0 +1,28 @@
+"""Import-time budget of the modules loaded by every process, e.g., the CLI
+and each DataLoader worker.
+
+Run with `python -m pytest tests` from the repository root.
+"""
+import sys
+import subprocess
+
+from arnet.utils.profiler import import_time
+
+
+BUDGET = 0.5 # seconds
+
+
+def test_import_config():
+    assert import_time('arnet.config') < BUDGET
+
+
+def test_import_utils():
+    assert import_time('arnet.utils') < BUDGET
+
+
+def test_utils_is_lazy():
+    code = ('import sys, arnet.utils; arnet.utils.Profiler; arnet.utils.benchmark_dataloader; '
+            'print(",".join(m for m in ["torch", "pytorch_lightning", "matplotlib", "redis", "astropy"] '
+            'if m in sys.modules))')
+    loaded = subprocess.check_output([sys.executable, '-c', code], text=True).strip()
+    assert loaded == ''
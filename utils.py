@@ -36,6 +36,18 @@ def get_log_intensity(class_str):
     return a + b
 
 
+def get_flare_classes(flares):
+    """GOES classes of flare records, without the empty ones (no class)."""
+    return [f for f in flares if f != '']
+
+
+def get_peak_intensity(flares):
+    """Log intensity of the largest flare. -9 if there is no flare."""
+    # A class without magnitude (e.g., 'C') is taken as magnitude 1.0
+    return max([get_log_intensity(f if len(f) > 1 else f + '1.0')
+                for f in get_flare_classes(flares)], default=-9.)
+
+
 def get_output(model, X):
     if hasattr(model, 'decision_function'):
         y_score = model.decision_function(X)